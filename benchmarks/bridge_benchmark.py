@@ -0,0 +1,155 @@
+"""Measure throughput and latency of the viewport bridge without Blender or a GPU
+
+Run from the addon directory with:
+
+    python -m benchmarks.bridge_benchmark
+
+For every resolution, a view update is sent and the benchmark waits for the
+resulting frame to be drawn (through a null GL sink) before sending the next
+one, so the reported frames per second are limited by the bridge's latency.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+
+from . import stubs
+
+
+DEFAULT_RESOLUTIONS = '640x360,1280x720,1920x1080,3840x2160'
+
+
+def parse_resolutions(value):
+    return [tuple(int(i) for i in res.split('x')) for res in value.split(',')]
+
+
+def make_view_matrix(frame):
+    # Move the camera a little every frame so every view update is different
+    return (
+        1.0, 0.0, 0.0, 0.0,
+        0.0, 1.0, 0.0, 0.0,
+        0.0, 0.0, 1.0, 0.0,
+        frame * 0.001, 0.0, -10.0, 1.0,
+    )
+
+
+PROJECTION_MATRIX = (
+    1.0, 0.0, 0.0, 0.0,
+    0.0, 1.0, 0.0, 0.0,
+    0.0, 0.0, -1.0, -1.0,
+    0.0, 0.0, -0.2, 0.0,
+)
+
+
+def run_resolution(panda_engine, null_gl, width, height, duration):
+    producer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frame_producer.py')
+    extern_conn = panda_engine.ExternalConnection([sys.executable, producer, stubs.ADDON_DIR])
+    panda_engine.ExternalConnection.ptr = extern_conn
+
+    frame_ready = threading.Event()
+
+    class BenchmarkEngine(panda_engine.PandaEngine):
+        def tag_redraw(self):
+            frame_ready.set()
+
+    engine = BenchmarkEngine()
+    try:
+        start_bytes = null_gl.bytes_uploaded
+        start_cpu = time.process_time()
+        start_time = time.perf_counter()
+        num_frames = 0
+        num_timeouts = 0
+        while time.perf_counter() - start_time < duration:
+            frame_ready.clear()
+            extern_conn.update_view(engine.view_id, width, height, PROJECTION_MATRIX, make_view_matrix(num_frames))
+            if not frame_ready.wait(1.0):
+                num_timeouts += 1
+                continue
+            engine._draw_texture() #pylint:disable=protected-access
+            num_frames += 1
+        elapsed = time.perf_counter() - start_time
+        blender_cpu = time.process_time() - start_cpu
+
+        blender_stats = extern_conn.get_stats()
+        processor_stats = extern_conn.request_processor_stats(5.0)
+    finally:
+        # Like Blender, deleting the last engine shuts down the connection
+        del engine
+        gc.collect()
+        panda_engine.ExternalConnection.destroy_ptr()
+
+    latency = blender_stats['timings'].get('view_to_frame', {})
+    frames_drawn = max(blender_stats['counters'].get('frames_drawn', 0), 1)
+    return {
+        'width': width,
+        'height': height,
+        'duration': elapsed,
+        'frames': num_frames,
+        'timeouts': num_timeouts,
+        'fps': num_frames / elapsed,
+        'latency_p50_ms': latency.get('p50_ms'),
+        'latency_p99_ms': latency.get('p99_ms'),
+        'bytes_per_frame': blender_stats['counters'].get('bytes_received', 0) / frames_drawn,
+        'uploaded_bytes_per_frame': (null_gl.bytes_uploaded - start_bytes) / frames_drawn,
+        'blender_cpu_ms_per_frame': blender_cpu / frames_drawn * 1000,
+        'processor_cpu_ms_per_frame': (
+            processor_stats['cpu_time'] / frames_drawn * 1000 if processor_stats else None
+        ),
+        'blender_stats': blender_stats,
+        'processor_stats': processor_stats,
+    }
+
+
+def format_result(result):
+    def fmt(value, spec):
+        return 'n/a' if value is None else format(value, spec)
+
+    return '{:>9} {:>8} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        '{}x{}'.format(result['width'], result['height']),
+        fmt(result['fps'], '.1f'),
+        fmt(result['latency_p50_ms'], '.2f'),
+        fmt(result['latency_p99_ms'], '.2f'),
+        fmt(result['bytes_per_frame'], '.0f'),
+        fmt(result['blender_cpu_ms_per_frame'], '.3f'),
+        fmt(result['processor_cpu_ms_per_frame'], '.3f'),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--resolutions', type=parse_resolutions, default=DEFAULT_RESOLUTIONS,
+        help='comma separated list of WIDTHxHEIGHT (default: {})'.format(DEFAULT_RESOLUTIONS)
+    )
+    parser.add_argument(
+        '--duration', type=float, default=3.0,
+        help='seconds to run each resolution for (default: 3)'
+    )
+    parser.add_argument(
+        '--json', metavar='PATH',
+        help='also write the full results, including all stats, to PATH'
+    )
+    args = parser.parse_args()
+
+    null_gl = stubs.install()
+    panda_engine = stubs.import_addon_module('panda_engine')
+
+    print('{:>9} {:>8} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'size', 'fps', 'p50 ms', 'p99 ms', 'bytes/frame', 'blender cpu', 'proc cpu'
+    ))
+    results = []
+    for width, height in args.resolutions:
+        result = run_resolution(panda_engine, null_gl, width, height, args.duration)
+        print(format_result(result))
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as resultsfile:
+            json.dump(results, resultsfile, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
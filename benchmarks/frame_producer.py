@@ -0,0 +1,71 @@
+"""Stand-in for processor_app that answers view updates with synthetic frames
+
+Launched by bridge_benchmark in place of processor_app with the addon
+directory and the address to connect to. Frames go through the same
+BlenderConnection as processor_app's, only the rendering is replaced by
+filling a buffer.
+"""
+import sys
+import time
+
+
+def run(addon_dir, conn_addr):
+    sys.path.insert(0, addon_dir)
+    from pipeline_stats import PipelineStats #pylint:disable=import-error
+    from processor_connection import BlenderConnection #pylint:disable=import-error
+
+    stats = PipelineStats()
+    connection = BlenderConnection(conn_addr, stats)
+    # Leave out interpreter startup and imports
+    start_cpu = time.process_time()
+    frames = {}
+    frame_number = 0
+    # Views waiting to be rendered, possibly until Blender grants another frame credit
+    views = {}
+
+    while connection.running:
+        if not connection.update_mailbox.wait(0.1):
+            continue
+
+        for update in connection.get_updates():
+            if update['type'] == 'view':
+                views[update['view_id']] = update
+            elif update['type'] == 'view_closed':
+                views.pop(update['view_id'], None)
+                connection.close_view(update['view_id'])
+            elif update['type'] == 'frame_ack':
+                connection.update_frame_credits(update)
+            elif update['type'] == 'stats_request':
+                snapshot = stats.snapshot()
+                snapshot['cpu_time'] = time.process_time() - start_cpu
+                connection.send_message({
+                    'type': 'stats',
+                    'timestamp': time.perf_counter(),
+                    'stats': snapshot,
+                })
+
+        for view_id, view in list(views.items()):
+            if not connection.has_frame_credit(view_id):
+                stats.count('renders_deferred')
+                continue
+            del views[view_id]
+
+            # Stand-in for rendering and reading back an image
+            start_time = time.perf_counter()
+            width, height = view['width'], view['height']
+            frame = frames.get((width, height))
+            if frame is None:
+                frame = frames[(width, height)] = bytearray(width * height * 4)
+            frame_number += 1
+            frame[:4] = frame_number.to_bytes(4, 'little')
+            stats.add_timing_since('render', start_time)
+
+            with stats.timer('send'):
+                connection.send_image(width, height, frame, width, height, view['timestamp'], view['view_id'])
+            stats.count('frames_rendered')
+
+    connection.shutdown()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1], sys.argv[2])
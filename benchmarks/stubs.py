@@ -0,0 +1,161 @@
+"""Stand-ins for the modules the addon expects from Blender, pman and OpenGL
+
+These only provide enough for the viewport bridge to run outside of Blender.
+The OpenGL stand-in is a null sink: texture uploads are counted but not
+performed, so no GPU (or display) is needed.
+"""
+import ctypes
+import importlib
+import os
+import sys
+import types
+
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_PACKAGE = 'blenderpanda'
+
+
+class _StubModule(types.ModuleType):
+    """Module that makes up classes for any attribute not explicitly set"""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = type(name, (), {})
+        setattr(self, name, value)
+        return value
+
+
+def _noop(*_args, **_kwargs):
+    return None
+
+
+class _NullGL(types.ModuleType):
+    """OpenGL.GL replacement that only keeps track of uploaded bytes"""
+
+    def __init__(self):
+        super().__init__('OpenGL.GL')
+        self.bytes_uploaded = 0
+        self.num_uploads = 0
+        # Stands in for mapped buffer memory, so the image is still copied like it would be
+        self._mapped = ctypes.create_string_buffer(0)
+        self._mapped_length = 0
+        self.error = types.SimpleNamespace(NullFunctionError=type('NullFunctionError', (Exception,), {}))
+
+    def __getattr__(self, name):
+        if name.startswith('GL_'):
+            return 0
+        if name.startswith('gl'):
+            return _noop
+        raise AttributeError(name)
+
+    @staticmethod
+    def glGenTextures(_count): #pylint:disable=invalid-name
+        return 1
+
+    @staticmethod
+    def glGenBuffers(count): #pylint:disable=invalid-name
+        return list(range(1, count + 1))
+
+    def _consume(self, data):
+        if data is not None and not isinstance(data, int) and hasattr(data, '__len__'):
+            self.bytes_uploaded += memoryview(data).nbytes
+            self.num_uploads += 1
+
+    def glBufferData(self, _target, _size, data, _usage): #pylint:disable=invalid-name
+        self._consume(data)
+
+    def glBufferSubData(self, _target, _offset, _size, data): #pylint:disable=invalid-name
+        self._consume(data)
+
+    def glMapBufferRange(self, _target, _offset, length, _access): #pylint:disable=invalid-name
+        if len(self._mapped) < length:
+            self._mapped = ctypes.create_string_buffer(length)
+        self._mapped_length = length
+        return ctypes.addressof(self._mapped)
+
+    def glUnmapBuffer(self, _target): #pylint:disable=invalid-name
+        self.bytes_uploaded += self._mapped_length
+        self.num_uploads += 1
+        return True
+
+    def glTexSubImage2D(self, *args): #pylint:disable=invalid-name
+        self._consume(args[-1])
+
+
+def _make_bpy():
+    bpy = _StubModule('bpy')
+    bpy.types = _StubModule('bpy.types')
+    bpy.types.RenderEngine = type('RenderEngine', (), {'tag_redraw': _noop})
+    bpy.props = _StubModule('bpy.props')
+    for prop in ('BoolProperty', 'IntProperty', 'FloatProperty', 'StringProperty', 'EnumProperty',
+                 'PointerProperty', 'CollectionProperty', 'FloatVectorProperty'):
+        setattr(bpy.props, prop, _noop)
+    bpy.data = types.SimpleNamespace(filepath='', libraries=[], materials=[], meshes=[])
+    bpy.app = types.SimpleNamespace(
+        binary_path='',
+        background=True,
+        handlers=types.SimpleNamespace(persistent=lambda func: func, load_post=[]),
+    )
+    bpy.path = types.SimpleNamespace(abspath=lambda path: path)
+    bpy.ops = _StubModule('bpy.ops')
+    bpy.utils = _StubModule('bpy.utils')
+
+    bpy_extras = _StubModule('bpy_extras')
+    bpy_extras.io_utils = _StubModule('bpy_extras.io_utils')
+    bpy_extras.io_utils.ExportHelper = type('ExportHelper', (), {})
+    return bpy, bpy_extras
+
+
+def _make_pman():
+    pman = _StubModule('pman')
+
+    class PManException(Exception):
+        pass
+
+    class NoConfigError(PManException):
+        pass
+
+    class CouldNotFindPythonError(PManException):
+        pass
+
+    def get_config(_startdir=None):
+        raise NoConfigError('no project in benchmarks')
+
+    pman.PManException = PManException
+    pman.NoConfigError = NoConfigError
+    pman.CouldNotFindPythonError = CouldNotFindPythonError
+    pman.get_config = get_config
+    pman.config_exists = lambda _startdir=None: False
+    pman.get_python_program = lambda _config=None: sys.executable
+    return pman
+
+
+def install():
+    """Put the stand-in modules in sys.modules and return the null GL module"""
+    bpy, bpy_extras = _make_bpy()
+    null_gl = _NullGL()
+    opengl = types.ModuleType('OpenGL')
+    opengl.GL = null_gl
+
+    sys.modules.update({
+        'bpy': bpy,
+        'bpy.types': bpy.types,
+        'bpy.props': bpy.props,
+        'bpy_extras': bpy_extras,
+        'bpy_extras.io_utils': bpy_extras.io_utils,
+        'mathutils': _StubModule('mathutils'),
+        'pman': _make_pman(),
+        'OpenGL': opengl,
+        'OpenGL.GL': null_gl,
+    })
+    return null_gl
+
+
+def import_addon_module(name):
+    """Import a module of the addon without running the addon's __init__ (which registers with Blender)"""
+    if ADDON_PACKAGE not in sys.modules:
+        package = types.ModuleType(ADDON_PACKAGE)
+        package.__path__ = [ADDON_DIR]
+        sys.modules[ADDON_PACKAGE] = package
+    return importlib.import_module('{}.{}'.format(ADDON_PACKAGE, name))
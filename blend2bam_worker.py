@@ -0,0 +1,45 @@
+import multiprocessing.connection
+import os
+import sys
+import traceback
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    'panda3d-blend2bam',
+))
+
+
+def convert(main, args):
+    sys.argv = ['blend2bam'] + list(args)
+    try:
+        main()
+    except SystemExit as exc:
+        if exc.code is None:
+            return 0
+        return exc.code if isinstance(exc.code, int) else 1
+    except Exception: #pylint:disable=broad-except
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def run(conn_addr):
+    # Connect before importing blend2bam so a broken install does not leave Blender waiting
+    with multiprocessing.connection.Client(conn_addr) as connection:
+        from blend2bam.cli import main #pylint:disable=no-name-in-module
+
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                break
+
+            returncode = convert(main, request['args'])
+            sys.stdout.flush()
+            sys.stderr.flush()
+            connection.send({
+                'returncode': returncode,
+            })
+
+
+if __name__ == '__main__':
+    run(sys.argv[1])
@@ -0,0 +1,84 @@
+"""Wire format for messages between Blender and processor_app
+
+High-frequency messages (view and background color updates) are packed into
+fixed-layout binary records. Everything else is pickled as before. Pickled
+data always starts with the PROTO opcode (0x80), so the two can be told apart
+by the leading magic bytes.
+"""
+import pickle
+import struct
+
+
+MAGIC = b'BPNM'
+PROTOCOL_VERSION = 2
+
+HEADER = struct.Struct('<4sHHd')
+
+KIND_VIEW = 1
+KIND_BACKGROUND_COLOR = 2
+
+# view id, width, height, projection matrix, view matrix
+VIEW_BODY = struct.Struct('<III16f16f')
+# RGBA
+BACKGROUND_COLOR_BODY = struct.Struct('<4f')
+
+
+def encode_update(update):
+    update_type = update['type']
+    if update_type == 'view':
+        return HEADER.pack(
+            MAGIC, PROTOCOL_VERSION, KIND_VIEW, update['timestamp']
+        ) + VIEW_BODY.pack(
+            update['view_id'],
+            update['width'],
+            update['height'],
+            *update['projection_matrix'],
+            *update['view_matrix']
+        )
+    elif update_type == 'background_color':
+        return HEADER.pack(
+            MAGIC, PROTOCOL_VERSION, KIND_BACKGROUND_COLOR, update['timestamp']
+        ) + BACKGROUND_COLOR_BODY.pack(*update['color'])
+
+    return pickle.dumps(update, pickle.HIGHEST_PROTOCOL)
+
+
+def decode_update(data):
+    if data[:len(MAGIC)] != MAGIC:
+        return pickle.loads(data)
+
+    _, version, kind, timestamp = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise RuntimeError('Unsupported message version: {}'.format(version))
+
+    if kind == KIND_VIEW:
+        view_id, width, height = struct.unpack_from('<III', data, HEADER.size)
+        matoffset = HEADER.size + 12
+        return {
+            'type': 'view',
+            'timestamp': timestamp,
+            'view_id': view_id,
+            'width': width,
+            'height': height,
+            'projection_matrix': struct.unpack_from('<16f', data, matoffset),
+            'view_matrix': struct.unpack_from('<16f', data, matoffset + 64),
+        }
+    elif kind == KIND_BACKGROUND_COLOR:
+        return {
+            'type': 'background_color',
+            'timestamp': timestamp,
+            'color': BACKGROUND_COLOR_BODY.unpack_from(data, HEADER.size),
+        }
+
+    raise RuntimeError('Unknown message kind: {}'.format(kind))
+
+
+def send_update(connection, update):
+    """Send an update and return the number of bytes sent"""
+    data = encode_update(update)
+    connection.send_bytes(data)
+    return len(data)
+
+
+def recv_update(connection):
+    return decode_update(connection.recv_bytes())
@@ -0,0 +1,95 @@
+import multiprocessing.connection
+import os
+import subprocess
+import threading
+
+
+class WorkerUnavailableError(Exception):
+    pass
+
+
+class ConversionWorker:
+    """A long-lived blend2bam_worker.py process that runs conversions on request
+
+    Keeping the interpreter running saves the startup and import time of
+    blend2bam for every conversion. A worker runs one conversion at a time.
+    """
+
+    workers = {}
+    _workers_lock = threading.Lock()
+
+    def __init__(self, pyprog):
+        self.pyprog = pyprog
+        self.connection = None
+        self._lock = threading.Lock()
+
+        scriptloc = os.path.join(
+            os.path.dirname(__file__),
+            'blend2bam_worker.py'
+        )
+
+        with multiprocessing.connection.Listener() as listener:
+            args = [
+                pyprog,
+                scriptloc,
+                str(listener.address),
+            ]
+            self.proc = subprocess.Popen(args)
+            if self.proc.poll() is None:
+                self.connection = listener.accept()
+
+    @classmethod
+    def get(cls, pyprog):
+        """Return a running worker for the given Python program, starting one if needed"""
+        with cls._workers_lock:
+            worker = cls.workers.get(pyprog)
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    worker.shutdown()
+                worker = cls(pyprog)
+                cls.workers[pyprog] = worker
+        return worker
+
+    @classmethod
+    def shutdown_all(cls):
+        with cls._workers_lock:
+            for worker in cls.workers.values():
+                worker.shutdown()
+            cls.workers.clear()
+
+    def is_alive(self):
+        return self.connection is not None and self.proc.poll() is None
+
+    def shutdown(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def convert(self, args):
+        """Run blend2bam with the given arguments and return its exit code
+
+        The worker is shared, so a conversion cannot be cancelled, callers
+        that are no longer interested should discard the result instead.
+        Raises WorkerUnavailableError if the worker is busy or died, in which
+        case the caller should fall back to running blend2bam on its own.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise WorkerUnavailableError('conversion worker is busy')
+
+        try:
+            if not self.is_alive():
+                raise WorkerUnavailableError('conversion worker is not running')
+            try:
+                self.connection.send({
+                    'args': args,
+                })
+                return self.connection.recv()['returncode']
+            except (EOFError, OSError) as err:
+                self.connection.close()
+                self.connection = None
+                raise WorkerUnavailableError('conversion worker died: {}'.format(err))
+        finally:
+            self._lock.release()
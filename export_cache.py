@@ -0,0 +1,150 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'blenderpanda_bam_cache')
+CACHE_SIZE = 512 * 1024 * 1024
+
+# Blocks that change with every save without affecting the exported scene
+# (GLOB holds the path the file was saved to, TEST the thumbnail)
+IGNORED_BLEND_BLOCKS = (
+    b'GLOB',
+    b'TEST',
+)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(hasher, path):
+    with open(path, 'rb') as fileobj:
+        for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def _hash_blend(hasher, path):
+    with open(path, 'rb') as fileobj:
+        header = fileobj.read(12)
+        if not header.startswith(b'BLENDER'):
+            # Probably compressed, fall back to hashing everything
+            hasher.update(header)
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+            return
+
+        hasher.update(header)
+        ptr_size = 8 if header[7:8] == b'-' else 4
+        endian = '<' if header[8:9] == b'v' else '>'
+        block_header = struct.Struct('{}4sI{}II'.format(endian, 'Q' if ptr_size == 8 else 'I'))
+        while True:
+            data = fileobj.read(block_header.size)
+            if len(data) < block_header.size:
+                hasher.update(data)
+                break
+            code, size = block_header.unpack(data)[:2]
+            if code in IGNORED_BLEND_BLOCKS:
+                fileobj.seek(size, os.SEEK_CUR)
+                continue
+            hasher.update(data)
+            hasher.update(fileobj.read(size))
+            if code == b'ENDB':
+                break
+
+
+def make_key(blendpath, library_paths=(), extra=()):
+    """Return a hex digest identifying the result of converting blendpath
+
+    The key covers the contents of the blend file and of its linked libraries
+    as well as anything in extra that affects the conversion (e.g., converter
+    version and arguments).
+    """
+    hasher = hashlib.sha256()
+    for value in extra:
+        hasher.update(repr(value).encode('utf8'))
+        hasher.update(b'\0')
+    _hash_blend(hasher, blendpath)
+    for libpath in sorted(library_paths):
+        hasher.update(libpath.encode('utf8'))
+        try:
+            _hash_file(hasher, libpath)
+        except OSError:
+            # Missing libraries are exported as missing
+            hasher.update(b'missing')
+    return hasher.hexdigest()
+
+
+def break_link(path):
+    """Remove path if it is a hard link into the cache, so writing it does not modify the cache"""
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class ExportCache:
+    """Content-addressed store of converted BAM files
+
+    Entries are served by hard link (or a copy if that fails) and the least
+    recently used entries are evicted once the cache grows beyond max_size
+    bytes.
+    """
+
+    def __init__(self, cachedir=CACHE_DIR, max_size=CACHE_SIZE):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(cachedir, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self.cachedir, key + '.bam')
+
+    def get(self, key, dstpath):
+        """Place the cached result for key at dstpath and return True, or return False on a miss"""
+        cachepath = self._get_path(key)
+        with self._lock:
+            if not os.path.exists(cachepath):
+                return False
+            # Mark as recently used
+            os.utime(cachepath)
+
+            if os.path.exists(dstpath):
+                os.remove(dstpath)
+            try:
+                os.link(cachepath, dstpath)
+            except OSError:
+                shutil.copyfile(cachepath, dstpath)
+        return True
+
+    def put(self, key, srcpath):
+        """Store a copy of the BAM file at srcpath under key"""
+        cachepath = self._get_path(key)
+        with self._lock:
+            tmpfd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.cachedir)
+            os.close(tmpfd)
+            try:
+                shutil.copyfile(srcpath, tmppath)
+                os.replace(tmppath, cachepath)
+            except OSError:
+                os.remove(tmppath)
+                raise
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith('.bam'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(i[1] for i in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+import bpy
+
+from . import operators
+
+
+EXPORT_DELAY = 0.3
+
+
+class ExportScheduler:
+    """Debounces viewport exports and runs the BAM conversion in the background
+
+    Call schedule() whenever the scene changes. Once no new changes came in
+    for delay seconds, the next call to poll() (which has to happen on
+    Blender's main thread) saves a copy of the blend file and converts it in a
+    worker thread. A newer change cancels a conversion still in progress
+    (one-shot conversion processes are killed, the result of the shared
+    conversion worker is discarded), and on_finished is only called with the BAM data (and the path it was written
+    to) of the newest conversion. The BAM file itself is removed right away.
+
+    on_save is called right before the blend file is saved and whatever it
+    returns is passed on to on_finished as a third argument (e.g., to tell
+    which changes made it into the export).
+    """
+
+    def __init__(self, on_finished, request_poll, delay=EXPORT_DELAY, stats=None, on_save=None):
+        self.on_finished = on_finished
+        self.on_save = on_save
+        self.delay = delay
+        self.stats = stats
+        self._request_poll = weakref.WeakMethod(request_poll)
+        self._lock = threading.Lock()
+        self._deadline = None
+        self._generation = 0
+        self._proc = None
+        self._timer = None
+
+    def schedule(self):
+        with self._lock:
+            self._generation += 1
+            self._deadline = time.perf_counter() + self.delay
+            self._kill_proc()
+
+            # Make sure poll() gets called once the delay is over
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self._wakeup)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+            self._deadline = None
+            self._kill_proc()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def poll(self):
+        with self._lock:
+            if self._deadline is None or time.perf_counter() < self._deadline:
+                return
+            self._deadline = None
+            generation = self._generation
+
+        if bpy.data.filepath:
+            filedir = os.path.dirname(bpy.data.filepath)
+        else:
+            filedir = tempfile.gettempdir()
+        config, user_config = operators.get_configs(filedir)
+        library_paths = operators.get_library_paths()
+
+        # Saving has to happen on the main thread, the conversion does not
+        start_time = time.perf_counter()
+        blendfd, blendpath = tempfile.mkstemp(prefix='__bp_temp_', suffix='.blend', dir=filedir)
+        os.close(blendfd)
+        save_state = self.on_save() if self.on_save is not None else None
+        bpy.ops.wm.save_as_mainfile(filepath=blendpath, copy=True)
+        self._add_timing('export_save', start_time)
+        bamfd, bampath = tempfile.mkstemp(prefix='__bp_temp_', suffix='.bam', dir=filedir)
+        os.close(bamfd)
+
+        thread = threading.Thread(
+            target=self._run_export,
+            args=(generation, config, user_config, blendpath, bampath, library_paths, save_state)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _add_timing(self, stage, start_time):
+        if self.stats is not None:
+            self.stats.add_timing_since(stage, start_time)
+
+    def _wakeup(self):
+        request_poll = self._request_poll()
+        if request_poll is not None:
+            request_poll()
+
+    def _kill_proc(self):
+        if self._proc is not None:
+            operators.kill_conversion(self._proc)
+        self._proc = None
+
+    def _set_proc(self, generation, proc):
+        # Only called for one-shot conversion processes, never for the shared conversion worker
+        with self._lock:
+            if generation != self._generation:
+                # Superseded before the conversion even started
+                operators.kill_conversion(proc)
+                return
+            self._proc = proc
+
+    def _run_export(self, generation, config, user_config, blendpath, bampath, library_paths, save_state):
+        start_time = time.perf_counter()
+        try:
+            success = operators.run_blend2bam(
+                config,
+                user_config,
+                blendpath,
+                bampath,
+                on_start=lambda proc: self._set_proc(generation, proc),
+                library_paths=library_paths
+            )
+        except Exception as err: #pylint:disable=broad-except
+            print('Viewport export failed: {}'.format(err))
+            success = False
+        finally:
+            os.remove(blendpath)
+
+        with self._lock:
+            is_newest = generation == self._generation
+            if is_newest:
+                self._proc = None
+        if is_newest:
+            self._add_timing('export', start_time)
+        elif self.stats is not None:
+            self.stats.count('exports_superseded')
+
+        bamdata = None
+        try:
+            if success and is_newest:
+                with open(bampath, 'rb') as bamfile:
+                    bamdata = bamfile.read()
+        finally:
+            os.remove(bampath)
+        if bamdata is not None:
+            self.on_finished(bamdata, bampath, save_state)
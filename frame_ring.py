@@ -0,0 +1,147 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+# Per-slot header: frame sequence number, payload size
+SLOT_HEADER = struct.Struct('=QQ')
+SLOT_ALIGN = 4096
+NUM_SLOTS = 3
+
+
+def _get_shm_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class FrameRing:
+    """A fixed pool of frame slots in a memory-mapped segment
+
+    The writer (processor_app) copies each frame into the next slot and only
+    sends a small message naming the slot over the connection. The reader
+    (Blender) then accesses the slot in place without any extra copies.
+
+    The reader removes the segment's name as soon as it has mapped it, so
+    the memory is freed once both sides are done with it, even if the
+    writer gets killed.
+    """
+
+    _counter = 0
+
+    def __init__(self, name, num_slots, slot_size, create=False):
+        self.name = name
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.is_writer = create
+        self._next_slot = 0
+        self._next_seq = 1
+
+        size = num_slots * slot_size
+        self._fd = None
+        if sys.platform == 'win32':
+            # Named shared memory lives as long as any process has it mapped
+            self._mmap = mmap.mmap(-1, size, tagname=name)
+        else:
+            if create:
+                self._fd = os.open(name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+                os.ftruncate(self._fd, size)
+            else:
+                self._fd = os.open(name, os.O_RDWR)
+            self._mmap = mmap.mmap(self._fd, size)
+            if not create:
+                self.unlink(name)
+        self._view = memoryview(self._mmap)
+
+    @classmethod
+    def create(cls, payload_size, num_slots=NUM_SLOTS):
+        slot_size = SLOT_HEADER.size + payload_size
+        slot_size = (slot_size + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+        cls._counter += 1
+        basename = 'bp_frames_{}_{}'.format(os.getpid(), cls._counter)
+        if sys.platform == 'win32':
+            name = basename
+        else:
+            name = os.path.join(_get_shm_dir(), basename)
+        return cls(name, num_slots, slot_size, create=True)
+
+    @staticmethod
+    def unlink(name):
+        """Remove the name of a segment, the memory stays mapped for anyone still using it"""
+        if sys.platform == 'win32':
+            # Named shared memory is freed when the last mapping is closed
+            return
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def open(cls, desc):
+        name, num_slots, slot_size = desc
+        return cls(name, num_slots, slot_size)
+
+    @property
+    def desc(self):
+        return (self.name, self.num_slots, self.slot_size)
+
+    @property
+    def capacity(self):
+        return self.slot_size - SLOT_HEADER.size
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Someone still holds a view into a slot, let the GC clean up
+            pass
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self.is_writer:
+            self.unlink(self.name)
+
+    def write(self, data, slot=None):
+        """Copy data into slot (by default the next one) and return a (slot, seq, size) tuple
+
+        Passing the slot of a frame that was never sent reuses it instead of
+        taking up another one.
+        """
+        data = memoryview(data).cast('B')
+        size = len(data)
+        if size > self.capacity:
+            raise ValueError('frame of {} bytes does not fit in a {} byte slot'.format(
+                size,
+                self.capacity
+            ))
+
+        if slot is None:
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.num_slots
+        seq = self._next_seq
+        self._next_seq += 1
+
+        offset = slot * self.slot_size
+        # Invalidate the slot while it is being written
+        SLOT_HEADER.pack_into(self._mmap, offset, 0, 0)
+        start = offset + SLOT_HEADER.size
+        self._view[start:start + size] = data
+        SLOT_HEADER.pack_into(self._mmap, offset, seq, size)
+
+        return slot, seq, size
+
+    def is_current(self, slot, seq):
+        offset = slot * self.slot_size
+        return SLOT_HEADER.unpack_from(self._mmap, offset)[0] == seq
+
+    def read(self, slot, seq):
+        """Return a view of the frame in slot, or None if it was overwritten"""
+        offset = slot * self.slot_size
+        cur_seq, size = SLOT_HEADER.unpack_from(self._mmap, offset)
+        if cur_seq != seq:
+            return None
+        start = offset + SLOT_HEADER.size
+        return self._view[start:start + size]
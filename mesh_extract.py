@@ -0,0 +1,203 @@
+import array
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Interleaved vertex layout shared with processor_app:
+# position (3 x float32), normal (3 x float32), texcoord (2 x float32), color (4 x uint8)
+VERTEX_STRUCT = struct.Struct('=3f3f2f4B')
+VERTEX_STRIDE = VERTEX_STRUCT.size
+
+if np is not None:
+    VERTEX_DTYPE = np.dtype([
+        ('position', '=f4', 3),
+        ('normal', '=f4', 3),
+        ('texcoord', '=f4', 2),
+        ('color', 'u1', 4),
+    ])
+    assert VERTEX_DTYPE.itemsize == VERTEX_STRIDE
+
+
+class MeshData:
+    """Triangulated mesh in a layout that can be copied straight into a GeomVertexData
+
+    There is one vertex per Blender loop. Triangles are sorted by material and
+    primitives holds a (material_index, first_index, num_indices) tuple for
+    each material in use.
+    """
+
+    def __init__(self, num_vertices, vertices, indices, primitives):
+        self.num_vertices = num_vertices
+        self.vertices = vertices
+        self.indices = indices
+        self.primitives = primitives
+
+
+def _get_buffer(count, typecode):
+    if np is not None:
+        return np.empty(count, dtype=typecode)
+    return array.array(typecode, bytes(count * array.array(typecode).itemsize))
+
+
+def _read_layers(mesh):
+    num_verts = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    num_polys = len(mesh.polygons)
+
+    mesh.calc_normals_split()
+
+    layers = {
+        'co': _get_buffer(num_verts * 3, 'f'),
+        'vertex_index': _get_buffer(num_loops, 'i'),
+        'normal': _get_buffer(num_loops * 3, 'f'),
+        'loop_start': _get_buffer(num_polys, 'i'),
+        'loop_total': _get_buffer(num_polys, 'i'),
+        'material_index': _get_buffer(num_polys, 'i'),
+        'uv': None,
+        'color': None,
+    }
+    mesh.vertices.foreach_get('co', layers['co'])
+    mesh.loops.foreach_get('vertex_index', layers['vertex_index'])
+    mesh.loops.foreach_get('normal', layers['normal'])
+    mesh.polygons.foreach_get('loop_start', layers['loop_start'])
+    mesh.polygons.foreach_get('loop_total', layers['loop_total'])
+    mesh.polygons.foreach_get('material_index', layers['material_index'])
+
+    if mesh.uv_layers.active is not None:
+        layers['uv'] = _get_buffer(num_loops * 2, 'f')
+        mesh.uv_layers.active.data.foreach_get('uv', layers['uv'])
+
+    if mesh.vertex_colors.active is not None:
+        layers['color'] = _get_buffer(num_loops * 3, 'f')
+        mesh.vertex_colors.active.data.foreach_get('color', layers['color'])
+
+    return layers
+
+
+def _build_numpy(num_loops, layers):
+    vertices = np.empty(num_loops, dtype=VERTEX_DTYPE)
+    vertices['position'] = layers['co'].reshape(-1, 3)[layers['vertex_index']]
+    vertices['normal'] = layers['normal'].reshape(-1, 3)
+    if layers['uv'] is not None:
+        vertices['texcoord'] = layers['uv'].reshape(-1, 2)
+    else:
+        vertices['texcoord'] = 0.0
+    if layers['color'] is not None:
+        colors = np.clip(layers['color'].reshape(-1, 3) * 255.0 + 0.5, 0, 255)
+        vertices['color'][:, :3] = colors.astype('u1')
+        vertices['color'][:, 3] = 255
+    else:
+        vertices['color'] = 255
+
+    # Fan-triangulate every polygon
+    loop_start = layers['loop_start']
+    tri_counts = layers['loop_total'] - 2
+    num_tris = int(tri_counts.sum())
+    poly_index = np.repeat(np.arange(len(tri_counts)), tri_counts)
+    fan_index = np.arange(num_tris) - np.repeat(np.cumsum(tri_counts) - tri_counts, tri_counts)
+    first_loop = loop_start[poly_index]
+    triangles = np.empty((num_tris, 3), dtype='=u4')
+    triangles[:, 0] = first_loop
+    triangles[:, 1] = first_loop + fan_index + 1
+    triangles[:, 2] = first_loop + fan_index + 2
+
+    tri_materials = layers['material_index'][poly_index]
+    order = np.argsort(tri_materials, kind='mergesort')
+    triangles = triangles[order]
+    tri_materials = tri_materials[order]
+
+    primitives = []
+    material_indices, firsts, counts = np.unique(tri_materials, return_index=True, return_counts=True)
+    for material_index, first, count in zip(material_indices, firsts, counts):
+        primitives.append((int(material_index), int(first) * 3, int(count) * 3))
+
+    return vertices.tobytes(), triangles.tobytes(), primitives
+
+
+def _build_array(num_loops, layers):
+    coords = layers['co']
+    vertex_index = layers['vertex_index']
+    normal = layers['normal']
+    uvs = layers['uv']
+    color = layers['color']
+
+    vertices = bytearray(num_loops * VERTEX_STRIDE)
+    for i in range(num_loops):
+        vidx = vertex_index[i] * 3
+        if color is not None:
+            rgb = [min(max(int(c * 255.0 + 0.5), 0), 255) for c in color[i * 3:i * 3 + 3]]
+        else:
+            rgb = [255, 255, 255]
+        VERTEX_STRUCT.pack_into(
+            vertices, i * VERTEX_STRIDE,
+            coords[vidx], coords[vidx + 1], coords[vidx + 2],
+            normal[i * 3], normal[i * 3 + 1], normal[i * 3 + 2],
+            uvs[i * 2] if uvs is not None else 0.0,
+            uvs[i * 2 + 1] if uvs is not None else 0.0,
+            rgb[0], rgb[1], rgb[2], 255
+        )
+
+    # Fan-triangulate every polygon, grouped by material
+    triangles_by_material = {}
+    for start, total, material_index in zip(
+            layers['loop_start'],
+            layers['loop_total'],
+            layers['material_index']
+    ):
+        triangles = triangles_by_material.setdefault(material_index, array.array('I'))
+        for i in range(1, total - 1):
+            triangles.extend((start, start + i, start + i + 1))
+
+    indices = array.array('I')
+    primitives = []
+    for material_index in sorted(triangles_by_material):
+        triangles = triangles_by_material[material_index]
+        primitives.append((material_index, len(indices), len(triangles)))
+        indices.extend(triangles)
+
+    return bytes(vertices), indices.tobytes(), primitives
+
+
+def extract_mesh(mesh):
+    """Read the geometry of a Blender mesh into a MeshData
+
+    Polygons are triangulated as fans, which is only correct for convex
+    polygons, but good enough for a preview.
+    """
+    layers = _read_layers(mesh)
+    num_loops = len(mesh.loops)
+    if np is not None:
+        vertices, indices, primitives = _build_numpy(num_loops, layers)
+    else:
+        vertices, indices, primitives = _build_array(num_loops, layers)
+
+    return MeshData(num_loops, vertices, indices, primitives)
+
+
+def find_changed_ranges(old_vertices, new_vertices, block_rows=64):
+    """Compare two vertex buffers of the same size and return the changed (start, end) row ranges
+
+    Rows are compared in blocks of block_rows, so ranges are rounded out to
+    block boundaries. Adjacent changed blocks are merged into one range.
+    """
+    old_vertices = memoryview(old_vertices).cast('B')
+    new_vertices = memoryview(new_vertices).cast('B')
+    num_rows = len(new_vertices) // VERTEX_STRIDE
+    block_size = block_rows * VERTEX_STRIDE
+
+    ranges = []
+    for start_row in range(0, num_rows, block_rows):
+        start = start_row * VERTEX_STRIDE
+        if old_vertices[start:start + block_size] == new_vertices[start:start + block_size]:
+            continue
+        end_row = min(start_row + block_rows, num_rows)
+        if ranges and ranges[-1][1] == start_row:
+            ranges[-1] = (ranges[-1][0], end_row)
+        else:
+            ranges.append((start_row, end_row))
+
+    return ranges
@@ -1,11 +1,19 @@
 import os
+import signal
 import subprocess
+import sys
 
 import bpy
 from bpy_extras.io_utils import ExportHelper
 
 import pman
 
+from .conversion_worker import ConversionWorker, WorkerUnavailableError
+from . import export_cache
+
+
+_EXPORT_CACHE = None
+
 
 def update_blender_path():
     startdir = os.path.dirname(bpy.data.filepath) if bpy.data.filepath else None
@@ -19,6 +27,142 @@ def update_blender_path():
         pman.write_user_config(user_config)
 
 
+def get_configs(filedir):
+    """Return the (config, user_config) of the project containing filedir, or (None, None)"""
+    try:
+        config = pman.get_config(filedir)
+    except pman.NoConfigError:
+        return None, None
+    return config, pman.get_user_config(config['internal']['projectdir'])
+
+
+def get_library_paths():
+    return [bpy.path.abspath(lib.filepath) for lib in bpy.data.libraries]
+
+
+def get_export_cache():
+    global _EXPORT_CACHE #pylint:disable=global-statement
+    if _EXPORT_CACHE is None:
+        _EXPORT_CACHE = export_cache.ExportCache()
+    return _EXPORT_CACHE
+
+
+def get_converter_version():
+    try:
+        import blend2bam
+    except ImportError:
+        return None
+    return getattr(blend2bam, '__version__', None)
+
+
+def get_blend2bam_args(config, srcpath, dstpath):
+    use_legacy_mats = (
+        config is None or
+        config['general']['material_mode'] == 'legacy'
+    )
+    material_mode = 'legacy' if use_legacy_mats else 'pbr'
+
+    return [
+        '--blender-dir', os.path.dirname(bpy.app.binary_path),
+        '--material-mode', material_mode,
+        srcpath,
+        dstpath,
+    ]
+
+
+def run_blend2bam(config, user_config, srcpath, dstpath, on_start=None, library_paths=()):
+    """Convert the blend file at srcpath to a BAM file at dstpath
+
+    Results are cached by the contents of srcpath and library_paths, so
+    converting unchanged data again is served from the export cache. If
+    given, on_start is called with the Popen object of a conversion process
+    started just for this conversion (e.g., to be able to kill it, see
+    kill_conversion()), conversions in the shared worker cannot be killed.
+    Returns True if the conversion succeeded.
+    Raises pman.CouldNotFindPythonError if no suitable Python could be found.
+    """
+    blend2bam_args = get_blend2bam_args(config, srcpath, dstpath)
+    in_venv = user_config is not None and user_config['python']['in_venv']
+    pyprog = None if in_venv else pman.get_python_program(config)
+
+    cache = get_export_cache()
+    try:
+        cache_key = export_cache.make_key(
+            srcpath,
+            library_paths,
+            ['venv' if in_venv else pyprog, get_converter_version()] + blend2bam_args[:-2]
+        )
+    except OSError as err:
+        print('Could not compute export cache key: {}'.format(err))
+        cache_key = None
+    if cache_key is not None and cache.get(cache_key, dstpath):
+        return True
+    # Do not write through a hard link into the cache
+    export_cache.break_link(dstpath)
+
+    success = _convert(config, in_venv, pyprog, blend2bam_args, on_start)
+    if success and cache_key is not None:
+        try:
+            # Never serve an empty output to later exports, whatever the converter reported
+            if os.path.getsize(dstpath) > 0:
+                cache.put(cache_key, dstpath)
+        except OSError as err:
+            print('Could not add export to cache: {}'.format(err))
+    return success
+
+
+def _get_file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _convert(config, in_venv, pyprog, blend2bam_args, on_start):
+    if in_venv:
+        # Use blend2bam from venv, pman.run_program() does not report whether the
+        # conversion succeeded, so check that it wrote a new, non-empty output
+        dstpath = blend2bam_args[-1]
+        prev_state = _get_file_state(dstpath)
+        pman.run_program(config, ['blend2bam'] + blend2bam_args)
+        state = _get_file_state(dstpath)
+        return state is not None and state[0] > 0 and state != prev_state
+
+    # Use bundled blend2bam, preferably through a warm worker
+    try:
+        return ConversionWorker.get(pyprog).convert(blend2bam_args) == 0
+    except WorkerUnavailableError as err:
+        print('Falling back to a one-shot conversion: {}'.format(err))
+
+    scriptloc = os.path.join(
+        os.path.dirname(__file__),
+        'blend2bam_wrapper.py'
+    )
+    args = [
+        pyprog,
+        scriptloc
+    ] + blend2bam_args
+    # Use a session of its own, so the Blender process blend2bam starts can be killed along with it
+    proc = subprocess.Popen(args, start_new_session=sys.platform != 'win32')
+    if on_start is not None:
+        on_start(proc)
+    return proc.wait() == 0
+
+
+def kill_conversion(proc):
+    """Kill a conversion process started by run_blend2bam() and anything it started"""
+    if proc.poll() is not None:
+        return
+    if sys.platform == 'win32':
+        proc.kill()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
 class ExportBam(bpy.types.Operator, ExportHelper):
     """Export to Panda3D's BAM file format"""
     bl_idname = 'panda_engine.export_bam'
@@ -41,27 +185,14 @@ class ExportBam(bpy.types.Operator, ExportHelper):
 
     def execute(self, _context):
         filedir = os.path.dirname(bpy.data.filepath) if bpy.data.filepath else os.path.dirname(self.filepath)
-        try:
-            config = pman.get_config(filedir)
-        except pman.NoConfigError as err:
-            config = None
-        if config:
-            user_config = pman.get_user_config(config['internal']['projectdir'])
-        else:
-            user_config = None
+        config, user_config = get_configs(filedir)
 
         try:
-            pycmd = pman.get_python_program(config)
+            pman.get_python_program(config)
         except pman.CouldNotFindPythonError as err:
             self.report({'ERROR'}, str(err))
             return {'CANCELLED'}
 
-        use_legacy_mats = (
-            config is None or
-            config['general']['material_mode'] == 'legacy'
-        )
-        material_mode = 'legacy' if use_legacy_mats else 'pbr'
-
         # Check if we need to convert the file
         try:
             if self.skip_up_to_date and os.stat(bpy.data.filepath).st_mtime <= os.stat(self.filepath).st_mtime:
@@ -75,38 +206,13 @@ class ExportBam(bpy.types.Operator, ExportHelper):
         tmpfname = os.path.join(filedir, '__bp_temp__.blend')
         bpy.ops.wm.save_as_mainfile(filepath=tmpfname, copy=True)
 
-        # Now convert the data to bam
-        blend2bam_args = [
-            '--blender-dir', os.path.dirname(bpy.app.binary_path),
-            '--material-mode', material_mode,
-        ]
-        blend2bam_args += [
-            tmpfname,
-            self.filepath
-        ]
-
-        retval = {'FINISHED'}
         try:
-            if user_config is not None and user_config['python']['in_venv']:
-                # Use blend2bam from venv
-                pman.run_program(config, ['blend2bam'] + blend2bam_args)
-            else:
-                # Use bundled blend2bam
-                scriptloc = os.path.join(
-                    os.path.dirname(__file__),
-                    'blend2bam_wrapper.py'
-                )
-                args = [
-                    pycmd,
-                    scriptloc
-                ] + blend2bam_args
-                if subprocess.call(args) != 0:
-                    retval = {'CANCELLED'}
+            success = run_blend2bam(config, user_config, tmpfname, self.filepath, library_paths=get_library_paths())
         finally:
             # Remove the temporary blend file
             os.remove(tmpfname)
 
-        return retval
+        return {'FINISHED'} if success else {'CANCELLED'}
 
 
 class CreateProject(bpy.types.Operator):
@@ -226,3 +332,4 @@ def register():
 
 def unregister():
     bpy.types.INFO_MT_file_export.remove(menu_func_export)
+    ConversionWorker.shutdown_all()
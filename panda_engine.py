@@ -1,12 +1,15 @@
+import array
+import ctypes
+import itertools
+import json
 import multiprocessing.connection
 import os
-import queue
 import struct
 import subprocess
 import sys
-import tempfile
 import threading
 import time
+import weakref
 
 
 from OpenGL import GL
@@ -14,11 +17,71 @@ from OpenGL import GL
 
 import pman
 import bpy
+from bpy_extras.io_utils import ExportHelper
+from mathutils import Matrix
+
+from . import bridge_protocol
+from .export_scheduler import ExportScheduler
+from .frame_ring import FrameRing, NUM_SLOTS
+from . import mesh_extract
+from . import pipeline_stats
+from . import reprojection
+from .update_mailbox import UpdateMailbox
+
+
+# Frames processor_app may have in flight per view. Leaving one ring slot
+# free means the slot being drawn is never overwritten.
+FRAME_CREDITS = NUM_SLOTS - 1
 
 
 class ExternalConnection:
     ptr = None
-    def __init__(self):
+    def __init__(self, args=None):
+        """Launch processor_app and connect to it
+
+        args can replace the command used to launch processor_app (e.g., for
+        benchmarks), the address to connect to is appended to it.
+        """
+        self.update_mailbox = UpdateMailbox()
+        self.frame_rings = {}
+        # Names of all frame rings processor_app announced, to clean up the ones never opened
+        self._ring_names = set()
+        self.connection = None
+        self._image_lock = threading.Lock()
+        self._latest_images = {}
+        self._redraw_engines = {}
+        self._views = []
+        self._next_view_id = 0
+        self._frames_acked = {}
+        self.stats = pipeline_stats.PipelineStats()
+        self._processor_stats = None
+        self._stats_event = threading.Event()
+        # Shared by all views, so every change is only exported once
+        self.export_scheduler = ExportScheduler(
+            self.update_scene,
+            self._request_redraw_all,
+            stats=self.stats,
+            on_save=self.get_export_state
+        )
+        # Sequence number of the last node, mesh or mesh range update
+        self._update_seq = 0
+
+        if args is None:
+            args = self._get_processor_args()
+
+        with multiprocessing.connection.Listener() as listener:
+            self.proc = subprocess.Popen(args + [str(listener.address)])
+            if self.proc.poll() is None:
+                self.connection = listener.accept()
+        self._running = True
+        self.reader = threading.Thread(target=self._reader_thread)
+        self.reader.start()
+        self.writer = threading.Thread(target=self._writer_thread)
+        self.writer.start()
+        # print('init complete')
+
+    @staticmethod
+    def _get_processor_args():
         filedir = os.path.dirname(bpy.data.filepath) if bpy.data.filepath else os.getcwd()
         try:
             config = pman.get_config(filedir)
@@ -27,10 +90,6 @@ class ExternalConnection:
             config = None
             user_config = None
 
-
-        self._tmpfnames = set()
-        self.update_queue = queue.Queue()
-
         if user_config is not None and user_config['python']['in_venv']:
             pyprog = 'python'
         else:
@@ -41,60 +100,213 @@ class ExternalConnection:
             'processor_app.py'
         )
 
-        with multiprocessing.connection.Listener() as listener:
-            args = [
-                pyprog,
-                scriptloc,
-                filedir,
-                str(listener.address),
-            ]
-            self.proc = subprocess.Popen(args)
-            if self.proc.poll() is None:
-                self.connection = listener.accept()
-        self._running = True
-        self.timer = threading.Thread(target=self._timer_thread)
-        self.timer.start()
-        # print('init complete')
+        return [
+            pyprog,
+            scriptloc,
+            filedir,
+        ]
 
     def destroy(self):
         # print("kill extern")
         self._running = False
+        self.export_scheduler.cancel()
+        self.update_mailbox.close()
         self.proc.terminate()
-        self.timer.join()
-        for tmpfname in self._tmpfnames:
-            os.remove(tmpfname)
+        self.reader.join()
+        self.writer.join()
+        for frame_ring in self.frame_rings.values():
+            frame_ring.close()
+        self.frame_rings = {}
+        # processor_app was terminated before it could remove its rings
+        for name in self._ring_names:
+            FrameRing.unlink(name)
+        self._ring_names = set()
         # print("del complete")
 
-    def _timer_thread(self):
-        while self._running:
-            for window in bpy.context.window_manager.windows:
-                for area in window.screen.areas:
-                    if area.type == 'VIEW_3D':
-                        area.tag_redraw()
-            time.sleep(0.1)
+    def open_view(self):
+        """Return the id of a new view, processor_app sets it up on its first view update"""
+        view_id = self._next_view_id
+        self._next_view_id += 1
+        self._views.append(view_id)
+        with self._image_lock:
+            self._frames_acked[view_id] = 0
+        self._ack_frames(view_id, 0)
+        return view_id
+
+    def close_view(self, view_id):
+        if view_id not in self._views:
+            return
+        self._views.remove(view_id)
+        self._redraw_engines.pop(view_id, None)
+        with self._image_lock:
+            self._latest_images.pop(view_id, None)
+            self._frames_acked.pop(view_id, None)
+            frame_ring = self.frame_rings.pop(view_id, None)
+        if frame_ring is not None:
+            frame_ring.close()
+        self._send_update('view_closed', {
+            'view_id': view_id,
+        })
+
+    def is_scene_owner(self, view_id):
+        """Only the oldest open view sends scene changes, the others would send the same ones"""
+        return bool(self._views) and self._views[0] == view_id
+
+    @property
+    def num_views(self):
+        return len(self._views)
+
+    def _ack_frames(self, view_id, count=1):
+        """Tell processor_app that count more frames of view_id were shown or dropped
+
+        Every acknowledged frame gives processor_app the credit to send
+        another one, so it never gets more than FRAME_CREDITS frames ahead.
+        """
+        with self._image_lock:
+            if view_id not in self._frames_acked:
+                return
+            self._frames_acked[view_id] += count
+            acked = self._frames_acked[view_id]
+        self.stats.count('frames_acked', count)
+        self._send_update('frame_ack', {
+            'view_id': view_id,
+            'credits': FRAME_CREDITS,
+            'acked': acked,
+        })
+
+    def add_redraw_engine(self, view_id, engine):
+        """Call engine.tag_redraw() whenever a new image for view_id arrives
+
+        Only a weak reference to engine is kept. tag_redraw() is a Blender (RNA)
+        function rather than a Python method, so weakref.WeakMethod cannot be used.
+        """
+        self._redraw_engines[view_id] = weakref.ref(engine)
+
+    def _request_redraw(self, view_id):
+        engine_ref = self._redraw_engines.get(view_id)
+        engine = engine_ref() if engine_ref is not None else None
+        if engine is not None:
+            engine.tag_redraw()
+
+    def _request_redraw_all(self):
+        for view_id in list(self._redraw_engines):
+            self._request_redraw(view_id)
+
+    def _reader_thread(self):
+        # Block on the connection and only request a redraw once a new image is available
+        try:
+            while self._running and self.connection is not None:
+                message = bridge_protocol.recv_update(self.connection)
+                if message['type'] == 'image':
+                    self.stats.add_timing_since('image_transfer', message['timestamp'])
+                    if 'view_timestamp' in message:
+                        self.stats.add_timing_since('view_to_frame', message['view_timestamp'])
+                    self.stats.count('images_received')
+                    view_id = message.get('view_id', 0)
+                    if 'ring' in message:
+                        self._ring_names.add(message['ring'][0])
+                    with self._image_lock:
+                        replaced = self._latest_images.get(view_id)
+                        if replaced is not None:
+                            # Only acknowledged together with the image that gets drawn, so
+                            # processor_app does not get ahead of the draw rate
+                            message['frames_replaced'] = replaced.get('frames_replaced', 0) + 1
+                            self.stats.count('images_collapsed')
+                        self._latest_images[view_id] = message
+                    self._request_redraw(view_id)
+                elif message['type'] == 'stats':
+                    self._processor_stats = message['stats']
+                    self._stats_event.set()
+        except (EOFError, OSError):
+            pass
+
+    def _writer_thread(self):
+        # Updates that pile up while a send is in progress are coalesced by the mailbox
+        while self._running and self.connection is not None:
+            if not self.update_mailbox.wait():
+                continue
+            for update in self.update_mailbox.get_all():
+                # Time spent waiting in the mailbox
+                self.stats.add_timing_since('update_queue', update['timestamp'])
+                try:
+                    self.stats.count('bytes_sent', bridge_protocol.send_update(self.connection, update))
+                except (BrokenPipeError,):
+                    self.connection = None
+                    break
 
     def _send_update(self, update_type, data):
-        self.update_queue.put({
+        timestamp = time.perf_counter()
+        self.update_mailbox.put({
             'type': update_type,
-            'timestamp': time.perf_counter(),
+            'timestamp': timestamp,
             **data,
         })
-
-        while self.connection is not None and not self.update_queue.empty():
-            try:
-                update = self.update_queue.get()
-                self.connection.send(update)
-            except (BrokenPipeError,):
-                self.connection = None
-
-    def update_scene(self, filepath):
-        self._tmpfnames.add(filepath)
+        return timestamp
+
+    def _send_node_update(self, update_type, data):
+        # processor_app keeps these around to apply them again to exports that do not include them yet
+        self._update_seq += 1
+        data['seq'] = self._update_seq
+        self._send_update(update_type, data)
+
+    def get_export_state(self):
+        """Return what processor_app needs to know about an export, called right before saving for it"""
+        # Meshes streamed so far are dropped when processor_app swaps in the export,
+        # so the next change of each has to be sent in full again
+        for engine_ref in self._redraw_engines.values():
+            engine = engine_ref()
+            if engine is not None:
+                engine.reset_streamed_meshes()
+        return {
+            # The last node update already included in the export
+            'update_seq': self._update_seq,
+            # Used to tell object nodes apart from the nodes making up an object
+            'object_names': [ob.name for ob in bpy.data.objects],
+        }
+
+    def update_scene(self, bamdata, filepath, export_state=None):
+        # filepath is only used to resolve relative paths in the BAM data
         self._send_update('scene', {
+            'data': bamdata,
             'path': filepath,
+            **(export_state or {}),
+        })
+
+    def update_nodes(self, objects, materials):
+        """Patch properties of objects and materials in the current scene
+
+        objects and materials map names to dictionaries of changed properties.
+        """
+        self._send_node_update('node_updates', {
+            'objects': objects,
+            'materials': materials,
+        })
+
+    def update_mesh(self, name, meshdata, material_names):
+        """Replace the geometry of an object in the current scene"""
+        self._send_node_update('mesh', {
+            'name': name,
+            'num_vertices': meshdata.num_vertices,
+            'vertices': meshdata.vertices,
+            'indices': meshdata.indices,
+            'primitives': meshdata.primitives,
+            'materials': material_names,
         })
 
-    def update_view(self, width, height, projmat, viewmat):
-        self._send_update('view', {
+    def update_mesh_ranges(self, name, ranges):
+        """Overwrite rows of vertex data previously sent with update_mesh
+
+        ranges is a list of (first_row, vertex_bytes) tuples.
+        """
+        self._send_node_update('mesh_ranges', {
+            'name': name,
+            'ranges': ranges,
+        })
+
+    def update_view(self, view_id, width, height, projmat, viewmat):
+        """Send a new view, images rendered for it carry the returned timestamp as view_timestamp"""
+        return self._send_update('view', {
+            'view_id': view_id,
             'width': width,
             'height': height,
             'projection_matrix': projmat,
@@ -106,21 +318,66 @@ class ExternalConnection:
             'color': color
         })
 
-    def get_image(self):
-        image = None
-        num_images = 0
-        while self.connection is not None and self.connection.poll():
-            image = self.connection.recv()
-            num_images += 1
-        # print('collapsed {} images'.format(num_images))
+    def request_processor_stats(self, timeout=1.0):
+        """Ask processor_app for a snapshot of its stats, returns None on timeout"""
+        self._stats_event.clear()
+        self._send_update('stats_request', {})
+        if not self._stats_event.wait(timeout):
+            return None
+        return self._processor_stats
+
+    def get_stats(self):
+        snapshot = self.stats.snapshot()
+        for update_type, count in self.update_mailbox.num_coalesced.items():
+            snapshot['counters']['coalesced_' + update_type] = count
+        return snapshot
+
+    def get_image(self, view_id):
+        with self._image_lock:
+            image = self._latest_images.pop(view_id, None)
+        if image is not None:
+            # The image is drawn before the next call, which is the earliest its ring slot can be reused
+            self._ack_frames(view_id, 1 + image.get('frames_replaced', 0))
+        if image is not None and 'ring' in image:
+            image['bytes'] = self._read_frame_ring(view_id, image)
+            if image['bytes'] is None:
+                # Overwritten by a newer frame before it could be shown
+                self.stats.count('frames_dropped')
+                image = None
+        if image is not None:
+            self.stats.count('bytes_received', len(image['bytes']))
         return image
 
+    def _read_frame_ring(self, view_id, image):
+        ring_desc = tuple(image['ring'])
+        frame_ring = self.frame_rings.get(view_id)
+        if frame_ring is None or frame_ring.desc != ring_desc:
+            if frame_ring is not None:
+                frame_ring.close()
+                del self.frame_rings[view_id]
+            try:
+                frame_ring = self.frame_rings[view_id] = FrameRing.open(ring_desc)
+            except OSError:
+                # The ring was already replaced by a newer (larger) one
+                return None
+
+        return frame_ring.read(image['slot'], image['seq'])
+
     @classmethod
     def get_ptr(cls):
         if cls.ptr is None:
             cls.ptr = ExternalConnection()
         return cls.ptr
 
+    @classmethod
+    def release_view(cls, view_id):
+        """Close a view and shut down processor_app once no views are left"""
+        if cls.ptr is None:
+            return
+        cls.ptr.close_view(view_id)
+        if cls.ptr.num_views == 0:
+            cls.destroy_ptr()
+
     @classmethod
     def destroy_ptr(cls):
         if cls.ptr is not None:
@@ -137,38 +394,128 @@ class PandaEngine(bpy.types.RenderEngine):
         self.tex = GL.glGenTextures(1)
         GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex)
         GL.glTexImage2D(
-            GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, 1, 1, 0,
-            GL.GL_RGB, GL.GL_UNSIGNED_BYTE, struct.pack('=BBB', 0, 0, 0)
+            GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, 1, 1, 0,
+            GL.GL_BGRA, GL.GL_UNSIGNED_BYTE, struct.pack('=BBBB', 0, 0, 0, 255)
         )
-        ExternalConnection.get_ptr()
+        self._tex_size = (1, 1)
+        # Double-buffered pixel unpack buffers for streaming images into the texture
+        try:
+            self._pbos = list(GL.glGenBuffers(2))
+        except GL.error.NullFunctionError:
+            self._pbos = []
+        self._pbo_index = 0
+        # Bytes allocated for each pixel unpack buffer
+        self._pbo_sizes = [0] * len(self._pbos)
+        self._map_pbos = True
+        extern_conn = ExternalConnection.get_ptr()
+        self.view_id = extern_conn.open_view()
+        extern_conn.add_redraw_engine(self.view_id, self)
         self._prev_view_mat = None
         self._prev_proj_mat = None
         self._prev_width = None
         self._prev_height = None
+        self._tex_coords = (1.0, 1.0)
+        self._tex_filter = GL.GL_NEAREST
+        self._view_timestamp = None
+        # Grid mesh and inverse view-projection matrix of the shown frame, for reprojecting it
+        self._frame_view_timestamp = None
+        self._frame_grid = None
+        self._frame_inv_viewproj = None
+        self._grid_indices = {}
+        self._synced_objects = None
+        self._synced_materials = None
+        # The last MeshData streamed for each object, used to only send changed vertices
+        self._streamed_meshes = {}
 
     def __del__(self):
         # print('del render engine')
-        ExternalConnection.destroy_ptr()
+        ExternalConnection.release_view(self.view_id)
 
 
     def _get_extern_conn(self):
         extern_conn = ExternalConnection.get_ptr()
         return extern_conn
 
+    def _upload_image(self, image):
+        size = (image['x'], image['y'])
+        fits = size[0] <= self._tex_size[0] and size[1] <= self._tex_size[1]
+        if not fits or (size != self._tex_size and image.get('scale', 1.0) >= 1.0):
+            # Only (re)allocate texture storage when the image does not fit or the full resolution
+            # size changes, reduced resolution images go into the bottom-left part of the texture
+            GL.glTexImage2D(
+                GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, size[0], size[1], 0,
+                GL.GL_BGRA, GL.GL_UNSIGNED_BYTE, None
+            )
+            self._tex_size = size
+
+        if not self._pbos:
+            GL.glTexSubImage2D(
+                GL.GL_TEXTURE_2D, 0, 0, 0, size[0], size[1],
+                GL.GL_BGRA, GL.GL_UNSIGNED_BYTE, image['bytes']
+            )
+            return
+
+        # Alternate between buffers, so filling one does not wait on the driver
+        # to finish transferring the previous image from the other
+        index = self._pbo_index
+        self._pbo_index = (index + 1) % len(self._pbos)
+        nbytes = len(image['bytes'])
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self._pbos[index])
+        if self._pbo_sizes[index] < nbytes:
+            # Only allocate buffer storage when an image does not fit
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, nbytes, None, GL.GL_STREAM_DRAW)
+            self._pbo_sizes[index] = nbytes
+        self._fill_pbo(image['bytes'])
+        GL.glTexSubImage2D(
+            GL.GL_TEXTURE_2D, 0, 0, 0, size[0], size[1],
+            GL.GL_BGRA, GL.GL_UNSIGNED_BYTE, ctypes.c_void_p(0)
+        )
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def _fill_pbo(self, data):
+        """Copy data to the start of the bound pixel unpack buffer"""
+        nbytes = len(data)
+        if self._map_pbos:
+            try:
+                # Invalidating orphans the old contents, the driver hands out fresh memory
+                # instead of waiting for pending transfers from this buffer
+                address = GL.glMapBufferRange(
+                    GL.GL_PIXEL_UNPACK_BUFFER, 0, nbytes,
+                    GL.GL_MAP_WRITE_BIT | GL.GL_MAP_INVALIDATE_BUFFER_BIT
+                )
+            except GL.error.NullFunctionError:
+                self._map_pbos = False
+            else:
+                if address:
+                    memoryview((ctypes.c_ubyte * nbytes).from_address(address)).cast('B')[:] = data
+                    GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
+                    return
+        GL.glBufferSubData(GL.GL_PIXEL_UNPACK_BUFFER, 0, nbytes, data)
+
     def _draw_texture(self):
         extern_conn = self._get_extern_conn()
 
         GL.glPushAttrib(GL.GL_ALL_ATTRIB_BITS)
         GL.glActiveTexture(GL.GL_TEXTURE0)
         GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex)
-        image = extern_conn.get_image()
+        image = extern_conn.get_image(self.view_id)
         if image:
-            GL.glTexImage2D(
-                GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, image['x'], image['y'], 0,
-                GL.GL_BGR, GL.GL_UNSIGNED_BYTE, image['bytes']
+            with extern_conn.stats.timer('upload'):
+                self._upload_image(image)
+            extern_conn.stats.count('frames_drawn')
+            # Only show the part of the texture that covers the view
+            self._tex_coords = (
+                image['width'] / self._tex_size[0],
+                image['height'] / self._tex_size[1],
             )
-        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
-        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            # Reduced resolution images (while navigating) are scaled up, smooth them out
+            self._tex_filter = GL.GL_LINEAR if image.get('scale', 1.0) < 1.0 else GL.GL_NEAREST
+            self._frame_view_timestamp = image.get('view_timestamp')
+            self._update_frame_grid(image)
+        tex_u, tex_v = self._tex_coords
+        reprojection_mat = self._get_reprojection_matrix()
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, self._tex_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, self._tex_filter)
 
         GL.glDisable(GL.GL_DEPTH_TEST)
         GL.glDisable(GL.GL_CULL_FACE)
@@ -185,17 +532,27 @@ class PandaEngine(bpy.types.RenderEngine):
         GL.glPushMatrix()
         GL.glLoadIdentity()
 
-        GL.glBegin(GL.GL_QUADS)
         GL.glColor3f(1.0, 1.0, 1.0)
-        GL.glTexCoord2f(0.0, 0.0)
-        GL.glVertex3i(-1, -1, 0)
-        GL.glTexCoord2f(1.0, 0.0)
-        GL.glVertex3i(1, -1, 0)
-        GL.glTexCoord2f(1.0, 1.0)
-        GL.glVertex3i(1, 1, 0)
-        GL.glTexCoord2f(0.0, 1.0)
-        GL.glVertex3i(-1, 1, 0)
-        GL.glEnd()
+        if reprojection_mat is not None:
+            # Warp the last frame to the current view until a frame for it arrives
+            GL.glLoadMatrixf(tuple(itertools.chain.from_iterable(reprojection_mat.col)))
+            vertices, indices, num_indices = self._frame_grid
+            GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+            GL.glInterleavedArrays(GL.GL_T2F_V3F, 0, vertices)
+            GL.glDrawElements(GL.GL_TRIANGLES, num_indices, GL.GL_UNSIGNED_INT, indices)
+            GL.glPopClientAttrib()
+            extern_conn.stats.count('frames_reprojected')
+        else:
+            GL.glBegin(GL.GL_QUADS)
+            GL.glTexCoord2f(0.0, 0.0)
+            GL.glVertex3i(-1, -1, 0)
+            GL.glTexCoord2f(tex_u, 0.0)
+            GL.glVertex3i(1, -1, 0)
+            GL.glTexCoord2f(tex_u, tex_v)
+            GL.glVertex3i(1, 1, 0)
+            GL.glTexCoord2f(0.0, tex_v)
+            GL.glVertex3i(-1, 1, 0)
+            GL.glEnd()
 
         GL.glPopMatrix()
         GL.glMatrixMode(GL.GL_MODELVIEW)
@@ -203,35 +560,163 @@ class PandaEngine(bpy.types.RenderEngine):
 
         GL.glPopAttrib()
 
+    def _update_frame_grid(self, image):
+        self._frame_grid = None
+        self._frame_inv_viewproj = None
+        if 'depth' not in image:
+            return
+
+        def to_matrix(values):
+            # Matrices are sent column-major
+            return Matrix([values[row::4] for row in range(4)])
+
+        try:
+            self._frame_inv_viewproj = (
+                to_matrix(image['projection_matrix']) * to_matrix(image['view_matrix'])
+            ).inverted()
+        except ValueError:
+            return
+
+        grid_size = image['depth_grid']
+        depth = array.array('f')
+        depth.frombytes(image['depth'])
+        vertices = reprojection.make_grid_vertices(depth, grid_size, *self._tex_coords)
+        indices = self._grid_indices.get(grid_size)
+        if indices is None:
+            indices = self._grid_indices[grid_size] = reprojection.make_grid_indices(grid_size).tobytes()
+        self._frame_grid = (vertices.tobytes(), indices, grid_size * grid_size * 6)
+
+    def _get_reprojection_matrix(self):
+        """Return the matrix that moves the shown frame to the current view, or None if it already matches"""
+        if (
+                self._frame_grid is None or
+                self._prev_proj_mat is None or
+                self._frame_view_timestamp == self._view_timestamp
+        ):
+            return None
+        return self._prev_proj_mat * self._prev_view_mat * self._frame_inv_viewproj
+
     def convert_scene(self):
+        """Schedule a full export of the scene, which runs in the background"""
+        self._get_extern_conn().export_scheduler.schedule()
+
+    def _get_node_updates(self, scene):
+        """Collect changes that can be patched into the scene already loaded by processor_app
+
+        Returns an (objects, materials, meshes) tuple, where meshes lists the
+        mesh objects whose geometry needs to be streamed. Returns None if the
+        change requires a full export instead (e.g., added, removed or renamed
+        objects, new materials, or data changes of other object types).
+        """
+        if self._synced_objects != {ob.name for ob in scene.objects}:
+            return None
+
+        objects = {}
+        meshes = []
+        for ob in scene.objects:
+            if ob.is_updated_data:
+                if ob.type == 'MESH':
+                    material_names = {slot.material.name for slot in ob.material_slots if slot.material}
+                    if not material_names <= self._synced_materials:
+                        return None
+                    meshes.append(ob)
+                elif ob.type == 'LAMP':
+                    lamp = ob.data
+                    objects.setdefault(ob.name, {})['light_color'] = tuple(lamp.color * lamp.energy)
+                else:
+                    return None
+            if ob.is_updated:
+                objects.setdefault(ob.name, {}).update({
+                    'matrix': tuple(itertools.chain.from_iterable(ob.matrix_world.col)),
+                    'visible': ob.is_visible(scene),
+                })
+
+        materials = {}
+        if bpy.data.materials.is_updated:
+            for mat in bpy.data.materials:
+                if not mat.is_updated:
+                    continue
+                pbr_settings = mat.pbr_export_settings
+                materials[mat.name] = {
+                    'diffuse': tuple(mat.diffuse_color * mat.diffuse_intensity) + (mat.alpha,),
+                    'specular': tuple(mat.specular_color * mat.specular_intensity) + (1.0,),
+                    'shininess': mat.specular_hardness,
+                    'base_color': tuple(pbr_settings.base_color_factor),
+                    'metallic': pbr_settings.metallic_factor,
+                    'roughness': pbr_settings.roughness_factor,
+                    'emission': tuple(pbr_settings.emissive_factor) + (1.0,),
+                }
+
+        return objects, materials, meshes
+
+    def reset_streamed_meshes(self):
+        self._streamed_meshes = {}
+
+    def _stream_mesh(self, scene, ob):
         extern_conn = self._get_extern_conn()
-        if bpy.data.filepath:
-            tmpfname = os.path.join(os.path.dirname(bpy.data.filepath), '__bp_temp__.bam')
-        else:
-            tmpfile = tempfile.NamedTemporaryFile(suffix='.bam', delete=False)
-            tmpfile.close()
-            tmpfname = tmpfile.name
-        # stime = time.perf_counter()
-        bpy.ops.panda_engine.export_bam(filepath=tmpfname)
-        # print('conversion took {:.2f}s'.format(
-        #     (time.perf_counter() - stime)
-        # ))
-        extern_conn.update_scene(
-            tmpfname
+        if ob.mode == 'EDIT':
+            # Make sure the mesh data reflects the edit mesh
+            ob.update_from_editmode()
+        with extern_conn.stats.timer('mesh_extract'):
+            mesh = ob.to_mesh(scene, True, 'PREVIEW')
+            try:
+                meshdata = mesh_extract.extract_mesh(mesh)
+            finally:
+                bpy.data.meshes.remove(mesh)
+        material_names = [slot.material.name if slot.material else None for slot in ob.material_slots]
+
+        prev_meshdata, prev_material_names = self._streamed_meshes.get(ob.name, (None, None))
+        same_topology = (
+            prev_meshdata is not None and
+            prev_meshdata.num_vertices == meshdata.num_vertices and
+            prev_meshdata.primitives == meshdata.primitives and
+            prev_meshdata.indices == meshdata.indices and
+            prev_material_names == material_names
         )
+        if same_topology:
+            # Only vertex attributes changed (e.g., moving vertices in edit mode or sculpting)
+            stride = mesh_extract.VERTEX_STRIDE
+            ranges = [
+                (start, meshdata.vertices[start * stride:end * stride])
+                for start, end in mesh_extract.find_changed_ranges(prev_meshdata.vertices, meshdata.vertices)
+            ]
+            if ranges:
+                extern_conn.update_mesh_ranges(ob.name, ranges)
+        else:
+            extern_conn.update_mesh(ob.name, meshdata, material_names)
+        self._streamed_meshes[ob.name] = (meshdata, material_names)
 
     def view_update(self, context):
         """ Called when the scene is changed """
         # print('view_update')
+        scene = context.scene
         extern_conn = self._get_extern_conn()
-        extern_conn.update_bg_color(list(context.scene.world.horizon_color[:])+[1.0])
-        self.convert_scene()
+        if not extern_conn.is_scene_owner(self.view_id):
+            # Another viewport already sends the changes, start from scratch if that one closes
+            self._synced_objects = None
+            self._draw_texture()
+            return
+
+        extern_conn.update_bg_color(list(scene.world.horizon_color[:])+[1.0])
+        node_updates = self._get_node_updates(scene)
+        if node_updates is None:
+            self.convert_scene()
+            extern_conn.export_scheduler.poll()
+            self._synced_objects = {ob.name for ob in scene.objects}
+            self._synced_materials = {mat.name for mat in bpy.data.materials}
+        else:
+            objects, materials, meshes = node_updates
+            for ob in meshes:
+                self._stream_mesh(scene, ob)
+            if objects or materials:
+                extern_conn.update_nodes(objects, materials)
         self._draw_texture()
 
 
     def view_draw(self, context):
         """ Called when viewport settings change """
         # print('view_update')
+        start_time = time.perf_counter()
 
         region = context.region
         view = context.region_data
@@ -253,13 +738,16 @@ class PandaEngine(bpy.types.RenderEngine):
             self._prev_proj_mat = pmat
 
             extern_conn = self._get_extern_conn()
-            extern_conn.update_view(
+            self._view_timestamp = extern_conn.update_view(
+                self.view_id,
                 region.width,
                 region.height,
-                [i for col in pmat.col for i in col],
-                [i for col in vmat.col for i in col],
+                tuple(itertools.chain.from_iterable(pmat.col)),
+                tuple(itertools.chain.from_iterable(vmat.col)),
             )
+        self._get_extern_conn().export_scheduler.poll()
         self._draw_texture()
+        self._get_extern_conn().stats.add_timing_since('draw', start_time)
 
 
     @classmethod
@@ -289,3 +777,38 @@ class PandaEngine(bpy.types.RenderEngine):
         if not bpy.app.background:
             keymap = bpy.context.window_manager.keyconfigs.default.keymaps['Screen']
             keymap.keymap_items.new(LaunchGame.bl_idname, 'P', 'PRESS')
+
+
+class ExportPipelineStats(bpy.types.Operator, ExportHelper):
+    """Write timings and counters of the viewport pipeline to a JSON file"""
+    bl_idname = 'panda_engine.export_pipeline_stats'
+    bl_label = 'Export Viewport Stats'
+
+    # For ExportHelper
+    filename_ext = '.json'
+    filter_glob = bpy.props.StringProperty(
+        default='*.json',
+        options={'HIDDEN'},
+    )
+
+    @classmethod
+    def poll(cls, _context):
+        return ExternalConnection.ptr is not None
+
+    def execute(self, _context):
+        extern_conn = ExternalConnection.get_ptr()
+        stats = {
+            'blender': extern_conn.get_stats(),
+            'processor': extern_conn.request_processor_stats(),
+        }
+        if stats['processor'] is None:
+            self.report({'WARNING'}, 'processor_app did not respond with its stats')
+
+        with open(self.filepath, 'w') as statsfile:
+            json.dump(stats, statsfile, indent=4, sort_keys=True)
+
+        for side in ('blender', 'processor'):
+            if stats[side] is not None:
+                for line in pipeline_stats.format_summary(stats[side]):
+                    print('{}: {}'.format(side, line))
+        return {'FINISHED'}
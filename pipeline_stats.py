@@ -0,0 +1,126 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+# Upper bounds (in milliseconds) of the histogram buckets, the last bucket catches everything else
+HISTOGRAM_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 33.0, 66.0, 133.0, 266.0, 533.0, 1066.0)
+
+
+class RollingHistogram:
+    """Keeps the last window samples (in seconds) of a timing"""
+
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.total_count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.total_count += 1
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {
+                'count': self.total_count,
+            }
+
+        def percentile(fraction):
+            return samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000
+
+        buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for value in samples:
+            value *= 1000
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+
+        return {
+            'count': self.total_count,
+            'window': len(samples),
+            'min_ms': samples[0] * 1000,
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': samples[-1] * 1000,
+            'buckets_ms': list(HISTOGRAM_BUCKETS) + ['inf'],
+            'bucket_counts': buckets,
+        }
+
+
+class PipelineStats:
+    """Thread-safe collection of per-stage timings and counters for the viewport pipeline
+
+    Timings are kept as rolling histograms of the last window samples,
+    counters (frames, dropped updates, bytes moved, etc.) are totals since
+    the last reset.
+    """
+
+    def __init__(self, window=256):
+        self.window = window
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = collections.Counter()
+
+    def add_timing(self, stage, seconds):
+        with self._lock:
+            histogram = self._timings.get(stage)
+            if histogram is None:
+                histogram = self._timings[stage] = RollingHistogram(self.window)
+            histogram.add(seconds)
+
+    def add_timing_since(self, stage, start_time):
+        """Record the time from start_time (a time.perf_counter() value) until now"""
+        self.add_timing(stage, time.perf_counter() - start_time)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing_since(stage, start_time)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+            return self._counters[name]
+
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+            self._counters = collections.Counter()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'timings': {stage: histogram.summary() for stage, histogram in self._timings.items()},
+                'counters': dict(self._counters),
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+
+def format_summary(snapshot):
+    """Return a short one line per stage description of a snapshot"""
+    lines = []
+    for stage, summary in sorted(snapshot['timings'].items()):
+        if 'window' not in summary:
+            continue
+        lines.append('{}: p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms ({} samples)'.format(
+            stage,
+            summary['p50_ms'],
+            summary['p95_ms'],
+            summary['max_ms'],
+            summary['count'],
+        ))
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('{}: {}'.format(name, value))
+    return lines
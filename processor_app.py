@@ -1,17 +1,26 @@
-import multiprocessing.connection
+import array
 import os
-import queue
 import struct
 import sys
 import time
-import threading
 
 from direct.showbase.ShowBase import ShowBase
+from direct.interval.IntervalGlobal import ivalMgr
 import panda3d.core as p3d
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'pman'))
 import pman #pylint:disable=wrong-import-position
 
+from pipeline_stats import PipelineStats #pylint:disable=wrong-import-position
+from processor_connection import BlenderConnection #pylint:disable=wrong-import-position
+from scene_loader import ( #pylint:disable=wrong-import-position
+    GEOM_HASH_TAG,
+    PendingNodeUpdates,
+    SceneLoader,
+    TextureCache,
+    merge_scene,
+)
+
 
 p3d.load_prc_file_data(
     '',
@@ -19,72 +28,212 @@ p3d.load_prc_file_data(
     'pstats-gpu-timing 1\n'
 )
 
+MAX_FPS = p3d.ConfigVariableDouble(
+    'bp-max-fps', 60.0,
+    'Upper limit on how many frames per second the viewport is rendered at'
+)
+FORCE_CONTINUOUS = p3d.ConfigVariableBool(
+    'bp-force-continuous', False,
+    'Render every frame instead of only when the view or scene changes (e.g., for animated previews)'
+)
+BUFFER_POWER_2 = p3d.ConfigVariableBool(
+    'bp-buffer-power-2', False,
+    'Round offscreen buffer sizes up to a power of two and only render and read back the viewport part of it'
+)
+BUFFER_ALIGN = p3d.ConfigVariableInt(
+    'bp-buffer-align', 4,
+    'Round offscreen buffer sizes up to a multiple of this many pixels'
+)
+BUFFER_BUCKET = p3d.ConfigVariableInt(
+    'bp-buffer-bucket', 128,
+    'Offscreen buffers are allocated in steps of this many pixels and only rebuilt when the view '
+    'leaves the current step, smaller views just render to part of the buffer'
+)
+TEXTURE_POOL_SIZE = p3d.ConfigVariableInt(
+    'bp-texture-pool-size', 1024,
+    'How many megabytes of textures no longer used by the scene are kept around for later scene reloads'
+)
+MOTION_SCALE = p3d.ConfigVariableDouble(
+    'bp-motion-scale', 0.5,
+    'Resolution scale (e.g., 0.5 or 0.25) to render a view at while it is being navigated, 1 to disable'
+)
+REFINE_DELAY = p3d.ConfigVariableDouble(
+    'bp-refine-delay', 0.15,
+    'Seconds a view has to be still before a full resolution frame replaces the reduced resolution ones'
+)
+DEPTH_GRID = p3d.ConfigVariableInt(
+    'bp-depth-grid', 32,
+    'Depth is sampled on a grid with this many cells per side and sent with every frame, so Blender can '
+    'reproject the last frame to a new view while waiting for the next one, 0 to disable'
+)
 
-class BlenderConnection:
-    def __init__(self, conn_addr):
-        self.connection = multiprocessing.connection.Client(conn_addr)
-        print('connected to', conn_addr)
-
-        self.update_queue = queue.Queue()
-        self.image_queue = queue.Queue()
-        self.running = True
-        self._conn_thread = threading.Thread(target=self._handle_connection)
-        self._conn_thread.start()
-
-    def __del__(self):
-        self.shutdown()
-
-    def shutdown(self):
-        self.running = False
-        self.connection.close()
-
-    def _handle_connection(self):
-        try:
-            while self.running:
-                if self.connection.poll():
-                    update = self.connection.recv()
-                    # print('update {} transfer took {:.2f}ms'.format(
-                    #     update['type'],
-                    #     (time.perf_counter() - update['timestamp']) * 1000
-                    # ))
-                    self.update_queue.put(update)
-
-                image = None
-                num_images = 0
-                while not self.image_queue.empty():
-                    num_images += 1
-                    image = self.image_queue.get()
-                if image is not None:
-                    self.connection.send(image)
-                # print('collapsed {} images'.format(num_images))
-        except (EOFError, OSError):
-            self.shutdown()
-
-    def send_image(self, xsize, ysize, imagebytes):
-        self.image_queue.put({
-            'type': 'image',
-            'timestamp': time.perf_counter(),
-            'x': xsize,
-            'y': ysize,
-            'bytes': bytes(imagebytes),
-        })
-
-    def get_updates(self):
-        updates = []
-        while not self.update_queue.empty():
-            updates.append(self.update_queue.get())
+# Struct format and maximum value of depth grid RAM images per component type
+DEPTH_FORMATS = {
+    p3d.Texture.T_float: ('f', 1.0),
+    p3d.Texture.T_unsigned_byte: ('B', 0xff),
+    p3d.Texture.T_unsigned_short: ('H', 0xffff),
+}
+
+DEPTH_GRID_VERT = """#version 130
+uniform mat4 p3d_ModelViewProjectionMatrix;
+in vec4 p3d_Vertex;
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+}
+"""
+
+# Every fragment of the grid buffer is one grid vertex, it copies the depth of the
+# texel that vertex lands on in the rendered part of the window's depth texture
+DEPTH_GRID_FRAG = """#version 130
+uniform sampler2D depth_texture;
+uniform ivec2 render_size;
+uniform int grid_size;
+out vec4 p3d_FragColor;
+void main() {
+    ivec2 vertex = ivec2(gl_FragCoord.xy);
+    ivec2 texel = min(vertex * render_size / grid_size, render_size - 1);
+    p3d_FragColor = vec4(texelFetch(depth_texture, texel, 0).r);
+}
+"""
+
+def make_mesh_vertex_format():
+    # Matches the interleaved layout written by mesh_extract
+    array_format = p3d.GeomVertexArrayFormat()
+    array_format.add_column(p3d.InternalName.get_vertex(), 3, p3d.Geom.NT_float32, p3d.Geom.C_point)
+    array_format.add_column(p3d.InternalName.get_normal(), 3, p3d.Geom.NT_float32, p3d.Geom.C_normal)
+    array_format.add_column(p3d.InternalName.get_texcoord(), 2, p3d.Geom.NT_float32, p3d.Geom.C_texcoord)
+    array_format.add_column(p3d.InternalName.get_color(), 4, p3d.Geom.NT_uint8, p3d.Geom.C_color)
+    return p3d.GeomVertexFormat.register_format(p3d.GeomVertexFormat(array_format))
+
+
+def make_depth_grid_buffer(win, depth_texture, grid_size):
+    """Make a buffer that samples a grid of depth values from a window's depth texture
+
+    Only the (grid_size + 1) by (grid_size + 1) grid is copied to RAM instead of
+    the whole depth buffer. The returned card needs a render_size shader input
+    with the size of the rendered part of the window. Returns (None, None) if
+    the buffer cannot be made.
+    """
+    fbprops = p3d.FrameBufferProperties()
+    fbprops.set_float_color(True)
+    fbprops.set_rgba_bits(32, 0, 0, 0)
+    buffer = win.make_texture_buffer(
+        'depth-grid',
+        grid_size + 1,
+        grid_size + 1,
+        p3d.Texture('depth-grid'),
+        True,
+        fbprops
+    )
+    if buffer is None:
+        return None, None
+    # Sample the depth after the window has rendered it in the same frame
+    buffer.set_sort(win.get_sort() + 1)
+
+    scene = p3d.NodePath('depth-grid')
+    scene.set_depth_test(False)
+    scene.set_depth_write(False)
+    camera = scene.attach_new_node(p3d.Camera('depth-grid-camera'))
+    lens = p3d.OrthographicLens()
+    lens.set_film_size(2, 2)
+    lens.set_near_far(-1, 1)
+    camera.node().set_lens(lens)
+    buffer.make_display_region().set_camera(camera)
+
+    cardmaker = p3d.CardMaker('depth-grid-card')
+    cardmaker.set_frame_fullscreen_quad()
+    card = scene.attach_new_node(cardmaker.generate())
+    card.set_shader(p3d.Shader.make(p3d.Shader.SL_GLSL, DEPTH_GRID_VERT, DEPTH_GRID_FRAG))
+    card.set_shader_input('depth_texture', depth_texture)
+    card.set_shader_input('grid_size', grid_size)
+    return buffer, card
+
+
+def read_depth_grid(texture, grid_size):
+    """Return the depth grid from a depth grid buffer's RAM image
+
+    Samples go row by row starting at the bottom and are returned as packed
+    32bit floats in the [0, 1] range, or None if the texture cannot be read.
+    """
+    depth_format = DEPTH_FORMATS.get(texture.get_component_type())
+    if depth_format is None or not texture.has_ram_image():
+        return None
+    typecode, max_value = depth_format
+    data = memoryview(texture.get_ram_image()).cast('B').cast(typecode)
+
+    # The depth is written to every channel of the buffer
+    stride = texture.get_num_components()
+    count = (grid_size + 1) ** 2
+    if len(data) < count * stride:
+        return None
+    return array.array('f', (data[i * stride] / max_value for i in range(count))).tobytes()
+
+
+class PStatsPipelineStats(PipelineStats):
+    """PipelineStats that also shows up in PStats as BlenderPanda levels"""
+
+    def __init__(self, window=256):
+        super().__init__(window)
+        self._collectors = {}
+
+    def _get_collector(self, name):
+        collector = self._collectors.get(name)
+        if collector is None:
+            collector = self._collectors[name] = p3d.PStatCollector('BlenderPanda:{}'.format(name))
+        return collector
+
+    def add_timing(self, stage, seconds):
+        super().add_timing(stage, seconds)
+        self._get_collector(stage).set_level(seconds * 1000)
+
+    def count(self, name, amount=1):
+        total = super().count(name, amount)
+        self._get_collector(name).set_level(total)
+        return total
+
+
+class View:
+    """Camera, lens and offscreen buffer for one Blender viewport"""
+
+    def __init__(self, view_id, render):
+        self.view_id = view_id
+        self.lens = p3d.MatrixLens()
+        self.cam = render.attach_new_node(p3d.Camera('view{}'.format(view_id)))
+        self.cam.node().set_lens(self.lens)
+        self.cam.node().set_active(True)
 
-        return updates
+        self.win = None
+        self.region = None
+        self.texture = p3d.Texture()
+        # Small buffer with depth sampled from the window on a grid, see make_depth_grid_buffer()
+        self.depth_grid_buffer = None
+        self.depth_grid_card = None
+        self.size = (1, 1)
+        # Matrices (as sent by Blender) of the last view update, for reprojecting images in Blender
+        self.projection_matrix = None
+        self.view_matrix = None
+        # Fraction of size that is rendered, less than 1 while the view is moving
+        self.scale = 1.0
+        self.render_size = (1, 1)
+        self.last_update = None
+        self.is_moving = False
+        self.needs_render = True
+        # Timestamp of the last view update
+        self.timestamp = None
+        # View state the image being rendered is for, see App.snapshot_frame()
+        self.frame = None
+
+    def get_outputs(self):
+        return [output for output in (self.win, self.depth_grid_buffer) if output is not None]
 
 
 class App(ShowBase):
     def __init__(self, workingdir, conn_addr):
         ShowBase.__init__(self)
-        self.view_lens = p3d.MatrixLens()
-        self.cam = p3d.NodePath(p3d.Camera('view'))
-        self.cam.node().set_lens(self.view_lens)
-        self.cam.node().set_active(True)
-        self.cam.reparent_to(self.render)
+        # Views share the scene, cam and win refer to the primary (oldest) view for renderers and such
+        self.views = {}
+        self.cam = None
+        self.win = None
 
         self.pipe = p3d.GraphicsPipeSelection.get_global_ptr().make_module_pipe('pandagl')
 
@@ -93,28 +242,46 @@ class App(ShowBase):
         p3d.get_model_path().prepend_directory(workingdir)
         self.workingdir = workingdir
 
-        self.texture = p3d.Texture()
-        self.win = None
         self.renderer = None
-        self.make_offscreen(1, 1)
+        # Buffers the renderer made for the primary view (e.g., from FilterManager)
+        self.renderer_outputs = []
+        self.renderer_tasks = []
+        self.scene_has_characters = False
+        self._idle_windows = []
+
+        clock = p3d.ClockObject.get_global_clock()
+        if MAX_FPS.get_value() > 0:
+            clock.set_mode(p3d.ClockObject.M_limited)
+            clock.set_frame_rate(MAX_FPS.get_value())
 
         self.disableMouse()
-        self.setFrameRateMeter(True)
+        self.show_frame_rate_meter = True
 
         self.image_width = 1
         self.image_height = 1
         self.image_data = struct.pack('=BBB', 0, 0, 0)
 
         self.scene = self.render.attach_new_node(p3d.PandaNode("Empty Scene"))
-
-        self.connection = BlenderConnection(conn_addr)
+        self.scene_nodes = {}
+        # Names of all Blender objects in the scene, and in the scene that is being loaded
+        self.object_names = set()
+        self.pending_object_names = set()
+        self.num_reused_nodes = 0
+        self.mesh_vertex_format = make_mesh_vertex_format()
+        self.pending_node_updates = PendingNodeUpdates(self.mesh_vertex_format.get_array(0).get_stride())
+        self.streamed_vertex_data = {}
+
+        self.stats = PStatsPipelineStats()
+        self.scene_loader = SceneLoader(TextureCache(TEXTURE_POOL_SIZE.get_value() * 1024 * 1024), self.stats)
+        self.connection = BlenderConnection(conn_addr, self.stats)
 
         def set_bg_clear_color(task):
             # Keep bg color working even if DisplayRegions get switched around
             # (e.g., from FilterManager)
+            cams = [view.cam for view in self.views.values()]
             for win in self.graphicsEngine.windows:
                 for dispregion in win.display_regions:
-                    if dispregion.get_camera() == self.cam:
+                    if dispregion.get_camera() in cams:
                         dispregion.set_clear_color_active(True)
                         dispregion.set_clear_color(self.bg_color)
             return task.cont
@@ -122,143 +289,615 @@ class App(ShowBase):
 
         def do_updates(task):
             if not self.connection.running:
+                self.scene_loader.shutdown()
                 sys.exit()
 
-            latest_scene_update = None
             for update in self.connection.get_updates():
                 # print('update: {}'.format(update))
                 update_type = update['type']
                 if update_type == 'view':
+                    view = self.get_view(update['view_id'])
+                    view.timestamp = update['timestamp']
+                    view.projection_matrix = update['projection_matrix']
+                    view.view_matrix = update['view_matrix']
+                    self.track_motion(view)
                     self.update_view(
+                        view,
                         update['width'],
                         update['height'],
                         self.load_matrix(update['projection_matrix']),
                         self.load_matrix(update['view_matrix']),
                     )
+                    view.needs_render = True
+                    continue
+                elif update_type == 'view_closed':
+                    self.remove_view(update['view_id'])
+                    continue
+                elif update_type == 'frame_ack':
+                    # Views waiting on credits still have needs_render set
+                    self.connection.update_frame_credits(update)
+                    continue
                 elif update_type == 'scene':
-                    latest_scene_update = update
+                    # The previous scene keeps rendering until the new one is loaded
+                    self.scene_loader.request(update['data'], update['path'])
+                    self.pending_object_names = set(update.get('object_names', ()))
+                    # Node updates sent after the blend file was saved for the export are not
+                    # in it and have to be applied again once the new scene is loaded
+                    update_seq = update.get('update_seq')
+                    self.pending_node_updates.discard(update_seq)
+                elif update_type in ('node_updates', 'mesh', 'mesh_ranges'):
+                    self.pending_node_updates.add(update)
+                    self.apply_node_updates(update)
                 elif update_type == 'background_color':
                     self.bg_color = p3d.LVector4(*update['color'])
+                elif update_type == 'stats_request':
+                    self.send_stats()
+                    continue
                 else:
                     raise RuntimeError('Unknown update type: {}'.format(update_type))
-
-            if latest_scene_update is not None:
-                self.update_scene(latest_scene_update['path'])
+                self.request_render()
+
+            new_scene = self.scene_loader.get_loaded_scene()
+            if new_scene is not None:
+                # Only the newest requested scene is ever loaded
+                self.object_names = self.pending_object_names
+                self.update_scene(new_scene)
+                # Node updates sent after the export still need to be applied
+                for node_update in self.pending_node_updates.get_updates():
+                    self.apply_node_updates(node_update)
+                self.request_render()
 
             return task.cont
         self.taskMgr.add(do_updates, 'Updates')
 
         def image_updates(task):
-            if self.texture.has_ram_image():
-                #start = time.perf_counter()
-                self.connection.send_image(
-                    self.texture.get_x_size(),
-                    self.texture.get_y_size(),
-                    memoryview(self.texture.get_ram_image_as('BGR'))
-                )
-                #print('Extern: Updated image data in {}ms'.format((time.perf_counter() - start) * 1000))
+            for view in self.views.values():
+                if view.frame is not None and view.texture.has_ram_image():
+                    self.send_view_image(view)
+                view.frame = None
             return task.cont
         self.taskMgr.add(image_updates, 'Upload Images')
 
+        def render_control(task):
+            # Only render (and copy the result to RAM) views that changed
+            render_all = FORCE_CONTINUOUS.get_value() or self.scene_is_animated()
+            rendering = []
+            for view in self.views.values():
+                refine = self.update_view_scale(view)
+                render = view.needs_render or render_all or refine
+                view.needs_render = False
+                if render and not self.connection.has_frame_credit(view.view_id):
+                    # Blender has not caught up with the frames in flight, skip rendering and
+                    # reading back until it acknowledges one
+                    view.needs_render = True
+                    render = False
+                    self.stats.count('renders_deferred')
+                view.frame = self.snapshot_frame(view) if render else None
+                if render:
+                    rendering.append(view)
+            self.set_rendering(rendering)
+            return task.cont
+        # Run right before igLoop (sort 50) renders the frame
+        self.taskMgr.add(render_control, 'Render Control', sort=49)
+
+    def scene_is_animated(self):
+        return self.scene_has_characters or ivalMgr.get_num_intervals() > 0
+
+    @staticmethod
+    def track_motion(view):
+        """A view update that closely follows the previous one means the user is navigating the view"""
+        now = time.perf_counter()
+        view.is_moving = (
+            view.last_update is not None and
+            now - view.last_update < REFINE_DELAY.get_value()
+        )
+        view.last_update = now
+
+    def update_view_scale(self, view):
+        """Pick the resolution scale to render view at, returns True if a full resolution refinement is due"""
+        if view.is_moving and time.perf_counter() - view.last_update >= REFINE_DELAY.get_value():
+            view.is_moving = False
+        scale = min(max(MOTION_SCALE.get_value(), 0.05), 1.0) if view.is_moving else 1.0
+        if scale == view.scale:
+            return False
+
+        view.scale = scale
+        if view.win is not None:
+            self.update_view_region(view)
+        return scale == 1.0
+
+    def request_render(self):
+        for view in self.views.values():
+            view.needs_render = True
+
+    def set_rendering(self, views):
+        """Only render the buffers of the given views
+
+        Other buffers (e.g., for filters) are only rendered if any view is.
+        """
+        view_windows = []
+        for view in self.views.values():
+            for output in view.get_outputs():
+                output.set_active(view in views)
+                view_windows.append(output)
+
+        if views:
+            for win in self._idle_windows:
+                win.set_active(True)
+            self._idle_windows = []
+        elif not self._idle_windows:
+            self._idle_windows = [
+                win for win in self.graphicsEngine.windows
+                if win.is_active() and win not in view_windows
+            ]
+            for win in self._idle_windows:
+                win.set_active(False)
+
+    @staticmethod
+    def snapshot_frame(view):
+        """Capture the view state a render is issued for
+
+        Updates arriving between issuing the render and sending the image must
+        not be attributed to that image.
+        """
+        return {
+            'timestamp': view.timestamp,
+            'projection_matrix': view.projection_matrix,
+            'view_matrix': view.view_matrix,
+            'scale': view.scale,
+            'render_size': view.render_size,
+            'render_start': time.perf_counter(),
+        }
+
+    def send_view_image(self, view):
+        frame = view.frame
+        # The texture only holds the rendered part of the buffer, see update_view_region()
+        xsize = view.texture.get_x_size()
+        ysize = view.texture.get_y_size()
+        width, height = frame['render_size']
+        # This is free for 32bit buffers since Panda already stores those as BGRA
+        with self.stats.timer('readback'):
+            imagebytes = memoryview(view.texture.get_ram_image_as('BGRA'))
+        extra = None
+        if view.depth_grid_buffer is not None and frame['projection_matrix'] is not None:
+            with self.stats.timer('depth_readback'):
+                depth = read_depth_grid(view.depth_grid_buffer.get_texture(), DEPTH_GRID.get_value())
+            if depth is not None:
+                extra = {
+                    'depth': depth,
+                    'depth_grid': DEPTH_GRID.get_value(),
+                    'projection_matrix': frame['projection_matrix'],
+                    'view_matrix': frame['view_matrix'],
+                }
+        with self.stats.timer('send'):
+            self.connection.send_image(
+                xsize,
+                ysize,
+                imagebytes,
+                width,
+                height,
+                frame['timestamp'],
+                view.view_id,
+                frame['scale'],
+                extra,
+            )
+        # From enabling rendering to having the image ready to send
+        self.stats.add_timing_since('render', frame['render_start'])
+        self.stats.count('frames_rendered')
+        if frame['scale'] < 1.0:
+            self.stats.count('frames_reduced')
+
+    def get_view(self, view_id):
+        view = self.views.get(view_id)
+        if view is None:
+            view = self.views[view_id] = View(view_id, self.render)
+            if len(self.views) == 2 and self.win is not None:
+                # Switch to the renderer for multiple views
+                self.update_rman()
+        return view
+
+    def remove_view(self, view_id):
+        view = self.views.pop(view_id, None)
+        if view is None:
+            return
+        was_primary = view.cam == self.cam
+        if view.win is not None:
+            if was_primary:
+                self.setFrameRateMeter(False)
+            self.remove_view_outputs(view)
+        view.cam.remove_node()
+        self.connection.close_view(view_id)
+        if was_primary:
+            self.update_primary_view()
+        elif len(self.views) == 1 and self.win is not None:
+            # Switch back to the configured renderer
+            self.update_rman()
+
+    def remove_view_outputs(self, view):
+        if view.win is not None and view.win == self.win:
+            # The renderer's buffers are hosted by the primary view's window
+            self.remove_renderer()
+        for output in view.get_outputs():
+            self.graphicsEngine.remove_window(output)
+        self._idle_windows = []
+        view.win = None
+        view.region = None
+        view.depth_grid_buffer = None
+        view.depth_grid_card = None
+
+    def get_primary_view(self):
+        if not self.views:
+            return None
+        return self.views[min(self.views)]
+
+    def update_primary_view(self):
+        """Point win and cam at the primary view and (re)create the renderer for it"""
+        primary = self.get_primary_view()
+        if primary is None or primary.win is None:
+            self.win = None
+            self.cam = None
+            return
+
+        self.setFrameRateMeter(False)
+        self.win = primary.win
+        self.cam = primary.cam
+        self.setFrameRateMeter(self.show_frame_rate_meter)
+        self.update_rman()
+
+    def remove_renderer(self):
+        """Undo what the renderer set up for the primary view"""
+        for output in self.renderer_outputs:
+            self.graphicsEngine.remove_window(output)
+        for task in self.renderer_tasks:
+            self.taskMgr.remove(task)
+        self.renderer_outputs = []
+        self.renderer_tasks = []
+        self._idle_windows = []
+        # FilterManager points the view's region at a camera showing its buffers instead
+        for view in self.views.values():
+            view.cam.node().set_initial_state(p3d.RenderState.make_empty())
+            if view.region is not None:
+                view.region.set_camera(view.cam)
+        self.render.clear_shader()
 
     def update_rman(self):
-        try:
-            pman_conf = pman.get_config(self.workingdir)
+        """(Re)create the renderer for the primary view
+
+        Renderers (e.g., simplepbr's post-processing and camera position
+        input) only know about a single camera, so with more than one view
+        the basic renderer is used to keep all views looking the same.
+        """
+        self.remove_renderer()
+        # New buffers are only listed once they are opened
+        self.graphicsEngine.open_windows()
+        outputs = list(self.graphicsEngine.windows)
+        tasks = self.taskMgr.getAllTasks()
+        pman_conf = None
+        if len(self.views) > 1:
+            print('Multiple views, falling back to basic renderer')
+        else:
+            try:
+                pman_conf = pman.get_config(self.workingdir)
+            except pman.NoConfigError:
+                print('No configuration found, falling back to basic renderer')
+        if pman_conf is not None:
             self.renderer = pman.create_renderer(self, pman_conf)
-        except pman.NoConfigError:
+        else:
             from pman import basicrenderer # pylint:disable=no-name-in-module
-            print('No configuration found, falling back to basic renderer')
             self.renderer = basicrenderer.BasicRenderer(self)
+        # Renderers do not clean up after themselves, keep track of what they made to remove it later
+        self.graphicsEngine.open_windows()
+        self.renderer_outputs = [win for win in self.graphicsEngine.windows if win not in outputs]
+        self.renderer_tasks = [task for task in self.taskMgr.getAllTasks() if task not in tasks]
+
+
+    @staticmethod
+    def get_buffer_bucket():
+        align = max(BUFFER_ALIGN.get_value(), 1)
+        bucket = max(BUFFER_BUCKET.get_value(), align)
+        return (bucket + align - 1) // align * align
+
+    def get_buffer_size(self, sizex, sizey):
+        # Blender regions can be 0 pixels wide or high, buffers cannot
+        sizex = max(sizex, 1)
+        sizey = max(sizey, 1)
+        if BUFFER_POWER_2.get_value():
+            return p3d.Texture.up_to_power_2(sizex), p3d.Texture.up_to_power_2(sizey)
+
+        bucket = self.get_buffer_bucket()
+        return (
+            (sizex + bucket - 1) // bucket * bucket,
+            (sizey + bucket - 1) // bucket * bucket,
+        )
 
+    def buffer_fits(self, view, sizex, sizey):
+        if not view.win:
+            return False
+
+        bufx, bufy = view.win.get_size()
+        fitx, fity = self.get_buffer_size(sizex, sizey)
+        if BUFFER_POWER_2.get_value():
+            return bufx == fitx and bufy == fity
+
+        # Allow the buffer to be one bucket too large, so dragging the view size
+        # back and forth over a bucket boundary does not keep rebuilding it
+        bucket = self.get_buffer_bucket()
+        return fitx <= bufx <= fitx + bucket and fity <= bufy <= fity + bucket
+
+    @staticmethod
+    def update_view_region(view):
+        # Only render to the bottom-left part of the buffer that the view (at its current scale) covers,
+        # Blender stretches that part over the whole viewport
+        view.render_size = (
+            max(int(round(view.size[0] * view.scale)), 1),
+            max(int(round(view.size[1] * view.scale)), 1),
+        )
+        bufx, bufy = view.win.get_size()
+        view.region.set_dimensions(
+            0, view.render_size[0] / bufx,
+            0, view.render_size[1] / bufy
+        )
+        # Copying to RAM goes through the overlay region, this limits the readback to the rendered part
+        view.win.get_overlay_display_region().set_dimensions(
+            0, view.render_size[0] / bufx,
+            0, view.render_size[1] / bufy
+        )
+        if view.depth_grid_card is not None:
+            view.depth_grid_card.set_shader_input('render_size', p3d.LVecBase2i(*view.render_size))
 
-    def make_offscreen(self, sizex, sizey):
-        sizex = p3d.Texture.up_to_power_2(sizex)
-        sizey = p3d.Texture.up_to_power_2(sizey)
+    def make_offscreen(self, view, sizex, sizey):
+        view.size = (sizex, sizey)
 
-        if self.win and self.win.get_size()[0] == sizex and self.win.get_size()[1] == sizey:
+        if self.buffer_fits(view, sizex, sizey):
             # The current window is good, don't waste time making a new one
+            self.update_view_region(view)
             return
 
-        use_frame_rate_meter = self.frameRateMeter is not None
-        self.setFrameRateMeter(False)
+        sizex, sizey = self.get_buffer_size(sizex, sizey)
 
-        self.graphicsEngine.remove_all_windows()
-        self.win = None
-        self.view_region = None
+        is_primary = view is self.get_primary_view()
+        if view.win is not None:
+            if view.win == self.win:
+                self.setFrameRateMeter(False)
+            self.remove_view_outputs(view)
+        self._idle_windows = []
+        view.needs_render = True
+
+        # Share the GSG with the other views, so the scene and its textures are only prepared once
+        gsg = None
+        for other in self.views.values():
+            if other is not view and other.win is not None:
+                gsg = other.win.get_gsg()
+                break
 
-        # First try to create a 24bit buffer to minimize copy times
+        # First try to create a 32bit buffer, its RAM image can be sent as BGRA without conversion
         fbprops = p3d.FrameBufferProperties()
-        fbprops.set_rgba_bits(8, 8, 8, 0)
+        fbprops.set_rgba_bits(8, 8, 8, 8)
         fbprops.set_depth_bits(24)
         winprops = p3d.WindowProperties.size(sizex, sizey)
         flags = p3d.GraphicsPipe.BF_refuse_window
         #flags = p3d.GraphicsPipe.BF_require_window
-        self.win = self.graphicsEngine.make_output(
+        view.win = self.graphicsEngine.make_output(
             self.pipe,
-            'window',
+            'window{}'.format(view.view_id),
             0,
             fbprops,
             winprops,
-            flags
+            flags,
+            gsg
         )
 
-        if self.win is None:
-            # Try again with an alpha channel this time (32bit buffer)
-            fbprops.set_rgba_bits(8, 8, 8, 8)
-            self.win = self.graphicsEngine.make_output(
+        if view.win is None:
+            # Try again without an alpha channel this time (24bit buffer)
+            fbprops.set_rgba_bits(8, 8, 8, 0)
+            view.win = self.graphicsEngine.make_output(
                 self.pipe,
-                'window',
+                'window{}'.format(view.view_id),
                 0,
                 fbprops,
                 winprops,
-                flags
+                flags,
+                gsg
             )
 
-        if self.win is None:
+        if view.win is None:
             print('Unable to open window')
             sys.exit(-1)
 
-        disp_region = self.win.make_mono_display_region()
-        disp_region.set_camera(self.cam)
+        disp_region = view.win.make_mono_display_region()
+        disp_region.set_camera(view.cam)
         disp_region.set_active(True)
         disp_region.set_clear_color_active(True)
         disp_region.set_clear_color(self.bg_color)
         disp_region.set_clear_depth(1.0)
         disp_region.set_clear_depth_active(True)
-        self.view_region = disp_region
+        view.region = disp_region
         self.graphicsEngine.open_windows()
 
-        self.setFrameRateMeter(use_frame_rate_meter)
-
-        self.update_rman()
+        view.texture = p3d.Texture()
+        view.win.addRenderTexture(view.texture, p3d.GraphicsOutput.RTM_copy_ram)
+        if DEPTH_GRID.get_value() > 0:
+            # Depth stays on the GPU, only the grid sampled from it is copied to RAM
+            depth_texture = p3d.Texture()
+            view.win.add_render_texture(
+                depth_texture,
+                p3d.GraphicsOutput.RTM_bind_or_copy,
+                p3d.GraphicsOutput.RTP_depth
+            )
+            view.depth_grid_buffer, view.depth_grid_card = make_depth_grid_buffer(
+                view.win,
+                depth_texture,
+                DEPTH_GRID.get_value()
+            )
+        self.update_view_region(view)
 
-        self.texture = p3d.Texture()
-        self.win.addRenderTexture(self.texture, p3d.GraphicsOutput.RTM_copy_ram)
+        if is_primary:
+            self.update_primary_view()
 
     def load_matrix(self, mat):
-        lmat = p3d.LMatrix4()
-
-        for i in range(4):
-            lmat.set_row(i, p3d.LVecBase4(*mat[i * 4: i * 4 + 4]))
-        return lmat
+        # Blender matrices are sent column-major, which matches Panda's row-vector convention
+        return p3d.LMatrix4(*mat)
 
-    def update_view(self, width, height, projmat, viewmat):
-        self.make_offscreen(width, height)
-        self.view_lens.set_user_mat(projmat)
+    def update_view(self, view, width, height, projmat, viewmat):
+        self.make_offscreen(view, width, height)
+        view.lens.set_user_mat(projmat)
         # Panda wants an OpenGL model matrix instead of an OpenGL view matrix
         viewmat.invert_in_place()
-        self.view_lens.set_view_mat(viewmat)
-
-    def update_scene(self, bampath):
-        #stime = time.perf_counter()
-        bampath = p3d.Filename.from_os_specific(bampath)
-        new_scene = self.loader.load_model(bampath, noCache=True)
-        # print('update took {:.2f}s'.format(
-        #     (time.perf_counter() - stime)
-        # ))
-        self.scene.remove_node()
-        new_scene.reparent_to(self.render)
-        self.scene = new_scene
+        view.lens.set_view_mat(viewmat)
+
+    def send_stats(self):
+        snapshot = self.stats.snapshot()
+        for update_type, count in self.connection.update_mailbox.num_coalesced.items():
+            snapshot['counters']['coalesced_' + update_type] = count
+        self.connection.send_message({
+            'type': 'stats',
+            'timestamp': time.perf_counter(),
+            'stats': snapshot,
+        })
+
+    def update_scene(self, new_scene):
+        num_nodes = new_scene.find_all_matches('**').get_num_paths()
+        with self.stats.timer('merge'):
+            self.scene, self.num_reused_nodes = merge_scene(self.scene, new_scene)
+        self.stats.count('scene_nodes_reused', self.num_reused_nodes)
+        print('Scene update reused {} of {} nodes'.format(self.num_reused_nodes, num_nodes))
+        # Upload textures and such of anything new before the scene shows up
+        if self.win is not None:
+            self.scene.prepare_scene(self.win.get_gsg())
+        self.scene_has_characters = not self.scene.find('**/+Character').is_empty()
+
+        self.streamed_vertex_data = {}
+        # Blender object names to nodes, keeping the top-most node for duplicate names
+        self.scene_nodes = {}
+        for nodepath in self.scene.find_all_matches('**'):
+            self.scene_nodes.setdefault(nodepath.get_name(), nodepath)
+
+    def apply_node_updates(self, update):
+        if update['type'] == 'mesh':
+            self.apply_mesh_update(update)
+            return
+        elif update['type'] == 'mesh_ranges':
+            self.apply_mesh_ranges(update)
+            return
+
+        nodepaths = []
+        for name, props in update['objects'].items():
+            nodepath = self.scene_nodes.get(name)
+            if nodepath is not None and not nodepath.is_empty():
+                nodepaths.append((nodepath, props))
+        # Matrices are world transforms, so parents have to be moved before their children
+        # or children would get the parent's move on top of their own new transform
+        nodepaths.sort(key=lambda item: item[0].get_num_nodes())
+
+        for nodepath, props in nodepaths:
+            if 'matrix' in props:
+                nodepath.set_mat(self.render, self.load_matrix(props['matrix']))
+            if 'visible' in props:
+                if props['visible']:
+                    nodepath.show()
+                else:
+                    nodepath.hide()
+            if 'light_color' in props:
+                color = p3d.LColor(*props['light_color'], 1.0)
+                for lightpath in self.find_object_nodes(nodepath):
+                    if isinstance(lightpath.node(), p3d.Light):
+                        lightpath.node().set_color(color)
+
+        if not update['materials']:
+            return
+
+        for material in self.scene.find_all_materials():
+            props = update['materials'].get(material.get_name())
+            if props is None:
+                continue
+
+            if material.has_base_color():
+                material.set_base_color(p3d.LColor(*props['base_color']))
+                material.set_metallic(props['metallic'])
+                material.set_roughness(props['roughness'])
+                material.set_emission(p3d.LColor(*props['emission']))
+            else:
+                material.set_diffuse(p3d.LColor(*props['diffuse']))
+                material.set_specular(p3d.LColor(*props['specular']))
+                material.set_shininess(props['shininess'])
+
+    def find_object_nodes(self, nodepath):
+        """Return nodepath and the nodes below it that belong to the same Blender object
+
+        Nodes of child objects (and anything below them) are left out.
+        """
+        nodes = [nodepath]
+        stack = list(nodepath.get_children())
+        while stack:
+            child = stack.pop()
+            if child.get_name() in self.object_names:
+                continue
+            nodes.append(child)
+            stack.extend(child.get_children())
+        return nodes
+
+    def apply_mesh_update(self, update):
+        nodepath = self.scene_nodes.get(update['name'])
+        if nodepath is None or nodepath.is_empty():
+            return
+
+        geom_nodes = [
+            i.node() for i in self.find_object_nodes(nodepath)
+            if i.node().is_geom_node()
+        ]
+        if not geom_nodes:
+            return
+
+        # Keep the render states of the old geometry, matched up by material name
+        states = {}
+        default_state = None
+        for geom_node in geom_nodes:
+            for state in geom_node.get_geom_states():
+                if default_state is None:
+                    default_state = state
+                if state.has_attrib(p3d.MaterialAttrib):
+                    material = state.get_attrib(p3d.MaterialAttrib).get_material()
+                    if material is not None:
+                        states.setdefault(material.get_name(), state)
+            geom_node.remove_all_geoms()
+            # No longer matches the exported geometry
+            geom_node.clear_python_tag(GEOM_HASH_TAG)
+        if default_state is None:
+            default_state = p3d.RenderState.make_empty()
+
+        vdata = p3d.GeomVertexData(update['name'], self.mesh_vertex_format, p3d.Geom.UH_dynamic)
+        vdata.unclean_set_num_rows(update['num_vertices'])
+        vdata.modify_array_handle(0).copy_data_from(update['vertices'])
+
+        indices = memoryview(update['indices'])
+        for material_index, first, count in update['primitives']:
+            prim = p3d.GeomTriangles(p3d.Geom.UH_static)
+            prim.set_index_type(p3d.Geom.NT_uint32)
+            handle = prim.modify_vertices().modify_handle()
+            handle.unclean_set_num_rows(count)
+            handle.copy_data_from(indices[first * 4:(first + count) * 4])
+
+            geom = p3d.Geom(vdata)
+            geom.add_primitive(prim)
+
+            materials = update['materials']
+            material_name = materials[material_index] if material_index < len(materials) else None
+            geom_nodes[0].add_geom(geom, states.get(material_name, default_state))
+
+        # Keep the vertex data around for patching with mesh_ranges updates
+        self.streamed_vertex_data[update['name']] = vdata
+
+    def apply_mesh_ranges(self, update):
+        vdata = self.streamed_vertex_data.get(update['name'])
+        if vdata is None:
+            return
+
+        # All geoms of the object share this vertex data, so writing to it updates them all
+        stride = self.mesh_vertex_format.get_array(0).get_stride()
+        handle = vdata.modify_array_handle(0)
+        for first_row, vertices in update['ranges']:
+            size = len(vertices)
+            handle.copy_subdata_from(first_row * stride, size, vertices, 0, size)
 
 
 def main():
@@ -0,0 +1,189 @@
+import multiprocessing.connection
+import threading
+import time
+
+import bridge_protocol
+from frame_ring import FrameRing
+from update_mailbox import UpdateMailbox
+
+
+class BlenderConnection:
+    def __init__(self, conn_addr, stats):
+        self.connection = multiprocessing.connection.Client(conn_addr)
+        print('connected to', conn_addr)
+        self.stats = stats
+
+        self.update_mailbox = UpdateMailbox()
+        # One ring per view, so frames of one view do not overwrite those of another
+        self.frame_rings = {}
+        self.use_frame_ring = True
+        self.running = True
+
+        # Latest-wins slot per view for outgoing images and a queue for other messages, guarded by _image_lock
+        self._image_lock = threading.Lock()
+        self._latest_images = {}
+        self._outgoing = []
+
+        # Flow control: per view, how many frames Blender allows to be sent in total and how many were sent
+        self._frame_limits = {}
+        self._frames_sent = {}
+
+        # Used to wake up the connection thread when an image is ready
+        self._wakeup_reader, self._wakeup_writer = multiprocessing.connection.Pipe(duplex=False)
+
+        self._conn_thread = threading.Thread(target=self._handle_connection)
+        self._conn_thread.start()
+
+    def __del__(self):
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.running:
+            return
+        self.running = False
+        self._wakeup()
+        with self._image_lock:
+            for frame_ring in self.frame_rings.values():
+                frame_ring.close()
+            self.frame_rings = {}
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send_bytes(b'\0')
+        except OSError:
+            pass
+
+    def _handle_connection(self):
+        # Block until either Blender sent something or an image is ready to go out
+        waitables = [self.connection, self._wakeup_reader]
+        try:
+            while self.running:
+                for ready in multiprocessing.connection.wait(waitables):
+                    if ready is self._wakeup_reader:
+                        while self._wakeup_reader.poll():
+                            self._wakeup_reader.recv_bytes()
+                        continue
+
+                    while self.connection.poll():
+                        data = self.connection.recv_bytes()
+                        update = bridge_protocol.decode_update(data)
+                        self.stats.add_timing_since('update_transfer', update['timestamp'])
+                        self.stats.count('bytes_received', len(data))
+                        self.update_mailbox.put(update)
+
+                with self._image_lock:
+                    messages = self._outgoing
+                    self._outgoing = []
+                    messages.extend(self._latest_images.values())
+                    self._latest_images = {}
+                for message in messages:
+                    self.stats.count('bytes_sent', bridge_protocol.send_update(self.connection, message))
+        except (EOFError, OSError):
+            self.shutdown()
+        finally:
+            self.connection.close()
+            self._wakeup_reader.close()
+            self._wakeup_writer.close()
+
+    def _get_frame_ring(self, view_id, size):
+        if not self.use_frame_ring:
+            return None
+
+        frame_ring = self.frame_rings.get(view_id)
+        if frame_ring is None or frame_ring.capacity < size:
+            if frame_ring is not None:
+                frame_ring.close()
+                frame_ring = None
+                del self.frame_rings[view_id]
+            try:
+                frame_ring = self.frame_rings[view_id] = FrameRing.create(size)
+            except OSError as err:
+                print('Unable to create shared memory for frames, falling back to pipe: {}'.format(err))
+                self.use_frame_ring = False
+        return frame_ring
+
+    def update_frame_credits(self, update):
+        """Apply a frame_ack update, which grants credits frames in flight on top of the acked ones"""
+        with self._image_lock:
+            self._frame_limits[update['view_id']] = update['credits'] + update['acked']
+
+    def has_frame_credit(self, view_id):
+        """Return True if Blender is ready for another frame of view_id"""
+        with self._image_lock:
+            return self._frames_sent.get(view_id, 0) < self._frame_limits.get(view_id, 0)
+
+    def close_view(self, view_id):
+        """Drop pending images and free the frame ring of a view that was closed"""
+        with self._image_lock:
+            self._latest_images.pop(view_id, None)
+            self._frame_limits.pop(view_id, None)
+            self._frames_sent.pop(view_id, None)
+            frame_ring = self.frame_rings.pop(view_id, None)
+            if frame_ring is not None:
+                frame_ring.close()
+
+    def send_image(self, xsize, ysize, imagebytes, width=None, height=None, view_timestamp=None, view_id=0,
+                   scale=1.0, extra=None):
+        """Queue an xsize by ysize BGRA image of view view_id to send to Blender
+
+        Only the bottom-left width by height part of the image is shown.
+        view_timestamp is the timestamp of the view update the image was
+        rendered for and scale the fraction of the view's resolution it was
+        rendered at. Anything in extra (e.g., depth samples) is added to the
+        message as is. Every image uses up one of the view's frame credits
+        (see has_frame_credit()), unless it replaces one that was not sent yet.
+        """
+        image = {
+            'type': 'image',
+            'timestamp': time.perf_counter(),
+            'x': xsize,
+            'y': ysize,
+            'width': xsize if width is None else width,
+            'height': ysize if height is None else height,
+            'view_id': view_id,
+            'scale': scale,
+        }
+        if extra:
+            image.update(extra)
+        if view_timestamp is not None:
+            image['view_timestamp'] = view_timestamp
+
+        imagebytes = memoryview(imagebytes)
+        with self._image_lock:
+            if not self.running:
+                return
+            replaced = self._latest_images.get(view_id)
+            frame_ring = self._get_frame_ring(view_id, imagebytes.nbytes)
+            if frame_ring is not None:
+                # An image that never went out takes its slot with it, so only frames
+                # Blender may be reading hold on to slots
+                reuse_slot = None
+                if replaced is not None and replaced.get('ring') == frame_ring.desc:
+                    reuse_slot = replaced['slot']
+                slot, seq, _ = frame_ring.write(imagebytes, reuse_slot)
+                image['ring'] = frame_ring.desc
+                image['slot'] = slot
+                image['seq'] = seq
+            else:
+                image['bytes'] = bytes(imagebytes)
+
+            wakeup = not self._latest_images
+            if replaced is not None:
+                # The replaced image never reaches Blender and is never acknowledged, so it does not use a credit
+                self.stats.count('images_collapsed')
+            else:
+                self._frames_sent[view_id] = self._frames_sent.get(view_id, 0) + 1
+            self._latest_images[view_id] = image
+            self.stats.count('frame_bytes', imagebytes.nbytes)
+
+        if wakeup:
+            self._wakeup()
+
+    def send_message(self, message):
+        """Queue a message other than an image to send to Blender"""
+        with self._image_lock:
+            self._outgoing.append(message)
+        self._wakeup()
+
+    def get_updates(self):
+        return self.update_mailbox.get_all()
@@ -0,0 +1,45 @@
+"""Grid meshes for reprojecting a rendered frame to a different view
+
+A frame is turned into a (grid_size + 1) by (grid_size + 1) grid of vertices
+in the normalized device coordinates of the view it was rendered for, using
+the depth sampled at every vertex. Drawing the grid with the current view's
+projection times the inverse of the frame's projection then warps the frame
+to the current view, all transformation is left to OpenGL.
+"""
+import array
+
+
+def make_grid_vertices(depth, grid_size, tex_u=1.0, tex_v=1.0):
+    """Return interleaved texcoord and position (GL_T2F_V3F) floats for a depth grid
+
+    depth holds (grid_size + 1) ** 2 depth values in the [0, 1] range, row by
+    row starting at the bottom. tex_u and tex_v are the texture coordinates of
+    the top-right corner of the frame.
+    """
+    vertices = array.array('f')
+    for row in range(grid_size + 1):
+        ypos = row / grid_size
+        for col in range(grid_size + 1):
+            xpos = col / grid_size
+            vertices.extend((
+                xpos * tex_u,
+                ypos * tex_v,
+                xpos * 2.0 - 1.0,
+                ypos * 2.0 - 1.0,
+                depth[row * (grid_size + 1) + col] * 2.0 - 1.0,
+            ))
+    return vertices
+
+
+def make_grid_indices(grid_size):
+    """Return indices of the two triangles of every grid cell"""
+    indices = array.array('I')
+    stride = grid_size + 1
+    for row in range(grid_size):
+        for col in range(grid_size):
+            corner = row * stride + col
+            indices.extend((
+                corner, corner + 1, corner + stride + 1,
+                corner, corner + stride + 1, corner + stride,
+            ))
+    return indices
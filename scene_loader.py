@@ -0,0 +1,347 @@
+import collections
+import hashlib
+import os
+import struct
+import threading
+import time
+
+import panda3d.core as p3d
+
+
+def read_bam_data(bamdata, bampath):
+    """Decode a scene from BAM data in memory
+
+    bampath is where the data was exported to and is used to resolve
+    relative paths (e.g., to textures).
+    """
+    stream = p3d.StringStream(bamdata)
+    bamfile = p3d.BamFile()
+    if not bamfile.open_read(stream, p3d.Filename.from_os_specific(bampath).get_fullpath()):
+        raise IOError('Could not read BAM header')
+    node = bamfile.read_node()
+    if node is None or not bamfile.resolve():
+        raise IOError('Could not read scene from BAM data')
+    bamfile.close()
+    return p3d.NodePath(node)
+
+
+GEOM_HASH_TAG = 'bp_geom_hash'
+
+# Only nodes without any extra properties of their own are compared and reused,
+# everything else (lights, characters, etc.) is always replaced
+REUSABLE_NODE_TYPES = (
+    p3d.PandaNode.get_class_type(),
+    p3d.ModelNode.get_class_type(),
+    p3d.ModelRoot.get_class_type(),
+    p3d.GeomNode.get_class_type(),
+)
+
+
+def hash_geoms(scene):
+    """Tag every GeomNode in scene with a hash of its geometry"""
+    for nodepath in scene.find_all_matches('**/+GeomNode'):
+        node = nodepath.node()
+        hasher = hashlib.sha1()
+        for geom in node.get_geoms():
+            vdata = geom.get_vertex_data()
+            hasher.update(str(vdata.get_format()).encode('utf8'))
+            for vertex_array in vdata.get_arrays():
+                hasher.update(memoryview(vertex_array))
+            for prim in geom.get_primitives():
+                hasher.update(prim.get_type().get_name().encode('utf8'))
+                if prim.is_indexed():
+                    hasher.update(memoryview(prim.get_vertices()))
+                else:
+                    hasher.update(struct.pack('=ii', prim.get_first_vertex(), prim.get_num_vertices()))
+                hasher.update(struct.pack('={}i'.format(len(prim.get_ends())), *prim.get_ends()))
+        node.set_python_tag(GEOM_HASH_TAG, hasher.digest())
+
+
+def _states_match(state, other):
+    if state.compare_to(other) == 0:
+        return True
+
+    # Materials are new objects with every load, so compare them by value
+    material_attrib = state.get_attrib(p3d.MaterialAttrib)
+    other_material_attrib = other.get_attrib(p3d.MaterialAttrib)
+    if material_attrib is None or other_material_attrib is None:
+        return False
+    if material_attrib.is_off() != other_material_attrib.is_off():
+        return False
+    material = material_attrib.get_material()
+    other_material = other_material_attrib.get_material()
+    if (material is None) != (other_material is None):
+        return False
+    if material is not None and (
+            material.get_name() != other_material.get_name() or
+            material.compare_to(other_material) != 0
+    ):
+        return False
+    return state.remove_attrib(p3d.MaterialAttrib).compare_to(other.remove_attrib(p3d.MaterialAttrib)) == 0
+
+
+def _nodes_match(node, other):
+    node_type = node.get_type()
+    if node_type != other.get_type() or node_type not in REUSABLE_NODE_TYPES:
+        return False
+    if (
+            node.get_transform() != other.get_transform() or
+            node.get_effects() != other.get_effects() or
+            not _states_match(node.get_state(), other.get_state()) or
+            node.is_overall_hidden() != other.is_overall_hidden()
+    ):
+        return False
+
+    tag_keys = sorted(node.get_tag_keys())
+    if tag_keys != sorted(other.get_tag_keys()):
+        return False
+    if any(node.get_tag(key) != other.get_tag(key) for key in tag_keys):
+        return False
+
+    if node.is_geom_node():
+        geom_hash = node.get_python_tag(GEOM_HASH_TAG)
+        if geom_hash is None or geom_hash != other.get_python_tag(GEOM_HASH_TAG):
+            return False
+        if node.get_num_geoms() != other.get_num_geoms():
+            return False
+        for i in range(node.get_num_geoms()):
+            if not _states_match(node.get_geom_state(i), other.get_geom_state(i)):
+                return False
+
+    return True
+
+
+def merge_scene(old_scene, new_scene):
+    """Reconcile the live old_scene with a newly loaded new_scene
+
+    Nodes are matched up by name along their path. Matching nodes that did
+    not change are kept, so their geometry and render state stay prepared on
+    the GPU. Subtrees that differ are replaced by, and extra ones taken
+    from, new_scene. Returns the root to use from now on and the number of
+    reused nodes.
+    """
+    if not _nodes_match(old_scene.node(), new_scene.node()):
+        new_scene.reparent_to(old_scene.get_parent(), old_scene.get_sort())
+        old_scene.remove_node()
+        return new_scene, 0
+
+    num_reused = 1
+    old_children = collections.OrderedDict()
+    for child in old_scene.get_children():
+        old_children.setdefault(child.get_name(), []).append(child)
+
+    for child in list(new_scene.get_children()):
+        matches = old_children.get(child.get_name())
+        if matches:
+            num_reused += merge_scene(matches.pop(0), child)[1]
+        else:
+            child.reparent_to(old_scene)
+
+    for children in old_children.values():
+        for child in children:
+            child.remove_node()
+
+    return old_scene, num_reused
+
+
+class TextureCache:
+    """Keeps textures loaded across scene reloads until their files change
+
+    Textures are shared through Panda's TexturePool, so a reloaded scene picks
+    up the Texture objects (including anything already uploaded to the GPU)
+    of the previous scene. Entries are keyed by path, modification time and
+    size: textures whose files changed are released before the next load, and
+    textures no longer used by the scene are released least recently used
+    first once they take up more than max_size bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # fullpath -> (mtime, size, texture)
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _stat(texture):
+        try:
+            stat = os.stat(texture.get_fullpath().to_os_specific())
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _release(self, fullpath):
+        texture = self._entries.pop(fullpath)[2]
+        p3d.TexturePool.release_texture(texture)
+
+    def refresh(self):
+        """Release textures whose files changed, call before loading a scene"""
+        for fullpath, (mtime, size, texture) in list(self._entries.items()):
+            if self._stat(texture) != (mtime, size):
+                self._release(fullpath)
+
+    def track(self, scene):
+        """Record the textures used by a newly loaded scene and evict unused ones"""
+        in_use = set()
+        for texture in scene.find_all_textures():
+            if not texture.has_fullpath():
+                continue
+            fullpath = texture.get_fullpath().get_fullpath()
+            stat = self._stat(texture)
+            if stat is None:
+                continue
+            in_use.add(fullpath)
+            self._entries[fullpath] = stat + (texture,)
+            self._entries.move_to_end(fullpath)
+
+        unused_size = sum(
+            entry[2].estimate_texture_memory()
+            for fullpath, entry in self._entries.items()
+            if fullpath not in in_use
+        )
+        for fullpath in list(self._entries):
+            if unused_size <= self.max_size:
+                break
+            if fullpath in in_use:
+                continue
+            unused_size -= self._entries[fullpath][2].estimate_texture_memory()
+            self._release(fullpath)
+
+
+class SceneLoader:
+    """Decodes scenes on a worker thread so the current scene keeps rendering
+
+    Only the newest requested scene is loaded. Requests that come in while a
+    load is running supersede it and its result is dropped.
+    """
+
+    def __init__(self, texture_cache, stats):
+        self.texture_cache = texture_cache
+        self.stats = stats
+        self._cond = threading.Condition()
+        self._request = None
+        self._generation = 0
+        self._loaded_scene = None
+        self.running = True
+
+        self._thread = threading.Thread(target=self._load_scenes)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+
+    def request(self, bamdata, bampath):
+        with self._cond:
+            self._generation += 1
+            self._request = (self._generation, bamdata, bampath)
+            # Anything loaded so far is out of date now
+            self._loaded_scene = None
+            self._cond.notify_all()
+
+    def get_loaded_scene(self):
+        """Return a newly loaded scene once, or None if there is none"""
+        with self._cond:
+            scene = self._loaded_scene
+            self._loaded_scene = None
+        return scene
+
+    def _load_scenes(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._request is not None or not self.running)
+                if not self.running:
+                    return
+                generation, bamdata, bampath = self._request
+                self._request = None
+
+            start_time = time.perf_counter()
+            try:
+                self.texture_cache.refresh()
+                scene = read_bam_data(bamdata, bampath)
+                self.texture_cache.track(scene)
+                hash_geoms(scene)
+            except Exception as err: #pylint:disable=broad-except
+                # Keep showing the old scene and keep this thread alive, a newer export will follow
+                print('Failed to load scene: {!r}'.format(err))
+                self.stats.count('scene_load_failures')
+                continue
+            self.stats.add_timing_since('load', start_time)
+
+            with self._cond:
+                if generation == self._generation:
+                    self._loaded_scene = scene
+                else:
+                    self.stats.count('scene_loads_superseded')
+
+
+class PendingNodeUpdates:
+    """Node, mesh and mesh range updates a newly loaded scene may not include yet
+
+    Only the latest state is kept, so memory does not grow with the number of
+    updates: properties are merged per object and material (keeping the
+    sequence number of the update that last set each one), and mesh ranges
+    are folded into the mesh update they patch.
+    """
+
+    def __init__(self, vertex_stride):
+        self.vertex_stride = vertex_stride
+        self.objects = {}
+        self.materials = {}
+        self.meshes = {}
+
+    def add(self, update):
+        seq = update.get('seq', 0)
+        if update['type'] == 'mesh':
+            mesh = dict(update)
+            mesh['vertices'] = bytearray(update['vertices'])
+            self.meshes[update['name']] = mesh
+        elif update['type'] == 'mesh_ranges':
+            mesh = self.meshes.get(update['name'])
+            if mesh is None:
+                # Patches geometry streamed before the export, which the export includes
+                return
+            for first_row, vertices in update['ranges']:
+                start = first_row * self.vertex_stride
+                mesh['vertices'][start:start + len(vertices)] = vertices
+            mesh['seq'] = seq
+        else:
+            for pending, changes in ((self.objects, update['objects']), (self.materials, update['materials'])):
+                for name, props in changes.items():
+                    pending_props = pending.setdefault(name, {})
+                    for prop, value in props.items():
+                        pending_props[prop] = (seq, value)
+
+    def discard(self, last_seq=None):
+        """Drop everything up to and including update last_seq, or everything if it is None"""
+        if last_seq is None:
+            self.objects = {}
+            self.materials = {}
+            self.meshes = {}
+            return
+
+        self.meshes = {name: mesh for name, mesh in self.meshes.items() if mesh.get('seq', 0) > last_seq}
+        for pending in (self.objects, self.materials):
+            for name, props in list(pending.items()):
+                props = {prop: value for prop, value in props.items() if value[0] > last_seq}
+                if props:
+                    pending[name] = props
+                else:
+                    del pending[name]
+
+    def get_updates(self):
+        """Return updates that bring a newly loaded scene up to date"""
+        def strip_seqs(pending):
+            return {
+                name: {prop: value for prop, (_, value) in props.items()}
+                for name, props in pending.items()
+            }
+
+        updates = list(self.meshes.values())
+        if self.objects or self.materials:
+            updates.append({
+                'type': 'node_updates',
+                'objects': strip_seqs(self.objects),
+                'materials': strip_seqs(self.materials),
+            })
+        return updates
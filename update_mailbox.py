@@ -0,0 +1,74 @@
+import collections
+import threading
+
+
+COALESCED_UPDATE_TYPES = (
+    'scene',
+    'background_color',
+)
+
+# Update types that are coalesced per value of the given field
+KEYED_UPDATE_TYPES = {
+    'mesh': 'name',
+    'view': 'view_id',
+    # Acknowledgements carry totals, so only the latest one per view matters
+    'frame_ack': 'view_id',
+}
+
+
+class UpdateMailbox:
+    """Thread-safe holding area for updates waiting to be sent or applied
+
+    Update types listed in coalesce_types get a single slot, so a newer update
+    replaces an older one that has not been picked up yet. Update types in
+    keyed_types get a slot per value of the mapped field (e.g., one per object
+    name). All other updates are kept in arrival order.
+    """
+
+    def __init__(self, coalesce_types=COALESCED_UPDATE_TYPES, keyed_types=None):
+        self.coalesce_types = set(coalesce_types)
+        self.keyed_types = dict(KEYED_UPDATE_TYPES if keyed_types is None else keyed_types)
+        self.num_coalesced = collections.Counter()
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._next_id = 0
+        self._closed = False
+
+    def put(self, update):
+        update_type = update['type']
+        with self._cond:
+            if update_type in self.keyed_types:
+                key = (update_type, update[self.keyed_types[update_type]])
+            elif update_type in self.coalesce_types:
+                key = update_type
+            else:
+                key = self._next_id
+                self._next_id += 1
+
+            if key in self._pending:
+                self.num_coalesced[update_type] += 1
+                # Re-insert so the newest update keeps its arrival order
+                del self._pending[key]
+            self._pending[key] = update
+            self._cond.notify_all()
+
+    def get_all(self):
+        """Remove and return all pending updates in arrival order"""
+        with self._cond:
+            updates = list(self._pending.values())
+            self._pending.clear()
+        return updates
+
+    def wait(self, timeout=None):
+        """Block until an update is pending or the mailbox is closed
+
+        Returns True if there are pending updates.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending or self._closed, timeout)
+            return bool(self._pending)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()